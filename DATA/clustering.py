@@ -1,6 +1,6 @@
 import pandas as pd
 import numpy as np
-from metrics import get_affinity
+from metrics import get_affinity, get_sparse_affinity
 from sklearn.cluster import SpectralClustering
 from configparser import ConfigParser
 
@@ -17,6 +17,10 @@ block           = 'DATA'
 fname_clusters  = config.get(block,'fname_clusters')
 n_clusters      = config.getint(block,'n_clusters')
 thickness_min   = config.getfloat(block,'thickness_min')
+affinity        = config.get(block,'affinity')
+n_neighbors     = config.getint(block,'n_neighbors')
+radius_max      = config.getfloat(block,'radius_max')
+eigen_solver    = config.get(block,'eigen_solver')
 debug           = True
 
 ###
@@ -30,8 +34,12 @@ if debug:
     Input parameters:
     number of clusters = {n_clusters}
     minimum thickness = {thickness_min} cm
+    affinity = {affinity}
+    eigensolver = {eigen_solver}
     """.format(n_clusters = n_clusters,
                thickness_min = thickness_min,
+               affinity = affinity,
+               eigen_solver = eigen_solver,
                )
           )
 
@@ -63,12 +71,18 @@ df.drop(['Cz.18','CAL002','Cz.n.a.2'],inplace=True)
 df.drop(['C22'],inplace=True)
 
 #Compute similarity matrix
-A = get_affinity(df, thickness_min)
+if affinity == 'knn':
+    A = get_sparse_affinity(df, thickness_min, n_neighbors=n_neighbors)
+elif affinity == 'radius':
+    A = get_sparse_affinity(df, thickness_min, radius_max=radius_max)
+else:
+    A = get_affinity(df, thickness_min)
 
 #Clustering
 model = SpectralClustering(
         n_clusters=n_clusters,
         affinity = 'precomputed',
+        eigen_solver = eigen_solver,
         )
 labels = model.fit_predict(A)
 df['cluster'] = labels
@@ -1,6 +1,6 @@
 import numpy as np
 import pandas as pd
-from metrics import get_affinity
+from metrics import get_affinity, get_selection
 from configparser import ConfigParser
 
 ###
@@ -49,19 +49,15 @@ df['error'].where(df.error>minimum_error,minimum_error, inplace=True)
 df['error_r'] = df.error/df.true
 
 ### Define validation/assimilation datasets
+### The greedy selection is nested: it is computed
+### once and truncated for each percentage
 A = get_affinity(df, thickness_min)
+order = get_selection(A, int(95*0.01*nobs))
 for percentAss in np.arange(5,105,5):
     if percentAss<100:
         df['dataset'] = 'validation'
         nobsAss = int(percentAss*0.01*nobs)
-        mask = ~np.diag(np.full(nobs,True))
-        for iobs in range(nobsAss):
-            maxAff = np.amax(A, axis=1, where=mask, initial=-1)
-            maxAff[maxAff<0] = 1.0
-            imin = np.argmin(maxAff)
-            mask[imin,:] = False
-            mask[:,imin] = False
-            df.iloc[imin,df.columns.get_loc('dataset')] = 'assimilation'
+        df.iloc[order[:nobsAss],df.columns.get_loc('dataset')] = 'assimilation'
     else:
         df['dataset'] = 'assimilation'
     fname_obs = "deposit_{:03d}.csv".format(percentAss)
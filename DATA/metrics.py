@@ -1,31 +1,175 @@
 import numpy as np
 import math
-from sklearn.metrics import pairwise_distances
+from scipy import sparse
+from sklearn.neighbors import BallTree
 
-################# Inputs ################# 
+################# Inputs #################
 deltas        = [75.0,1.0]               # Scales for distances [km,dimensionless]
-########################################## 
+radius        = 6371.0                   # Earth radius [km]
+block_size    = 1024                     # Rows of the affinity matrix computed at once
+##########################################
 
-def get_affinity(df,thickness_min):
-    #Define X (n_samples_X, n_features)
-    X = df[['latitude','longitude']].to_numpy()
+def get_affinity(df,thickness_min,dtype=np.float64,threshold=None):
+    """
+    Compute the affinity matrix using the haversine
+    distance and the log10 ratio of thicknesses.
+    The matrix is computed by blocks of rows
 
-    #Compute distance matrix
-    D1 = pairwise_distances(X,metric=haversine_distance)
+    Parameters
+    ----------
+    df: pandas DataFrame
+        Observations with latitude, longitude and thickness
+    thickness_min: float
+        Thickness values are bounded below by this value
+    dtype: str or numpy dtype, optional
+        Data type of the affinity matrix (e.g. float32).
+        Distances are always computed in double precision
+    threshold: float, optional
+        If defined, affinities below this value are dropped
+        and a sparse matrix is returned
 
-    #Define X (n_samples_X, n_features)
-    X = df[['thickness']].to_numpy()
-    X[X<thickness_min] = thickness_min
+    Returns
+    -------
+    A: numpy array or scipy sparse matrix
+        Affinity matrix with shape (nobs,nobs). A CSR
+        matrix is used if threshold is defined
+    """
+    lat  = np.radians(df['latitude'].to_numpy(dtype=float))
+    lon  = np.radians(df['longitude'].to_numpy(dtype=float))
+    logy = np.log10(np.maximum(df['thickness'].to_numpy(dtype=float),thickness_min))
+    nobs = len(df)
+    delta1,delta2 = deltas
 
-    #Compute distance matrix
-    D2 = pairwise_distances(X,metric=log_distance)
+    if threshold is None:
+        A = np.empty((nobs,nobs),dtype=dtype)
+    else:
+        rows, cols, values = [], [], []
 
-    #Compute similarity matrix
-    delta1,delta2 = deltas
-    A = np.exp(-0.5 * (D1**2 / delta1**2 + D2**2 / delta2**2))
+    for i0 in range(0,nobs,block_size):
+        i  = slice(i0,i0+block_size)
+        #Compute distance matrices
+        D1 = get_haversine(lat[i,None],lon[i,None],lat,lon)
+        D2 = logy[i,None] - logy
+        #Compute similarity matrix
+        a  = np.exp(-0.5 * (D1**2 / delta1**2 + D2**2 / delta2**2))
+        if threshold is None:
+            A[i] = a
+        else:
+            r,c = np.nonzero(a>=threshold)
+            rows.append(r+i0)
+            cols.append(c)
+            values.append(a[r,c].astype(dtype))
 
+    if threshold is not None:
+        A = sparse.csr_matrix((np.concatenate(values),
+                               (np.concatenate(rows),np.concatenate(cols))),
+                              shape=(nobs,nobs))
     return A
 
+def get_sparse_affinity(df,thickness_min,n_neighbors=None,radius_max=None,dtype=np.float64):
+    """
+    Compute a sparse affinity matrix restricted to the
+    k nearest neighbours or to the sites within a cutoff
+    radius. Neighbours are found using a BallTree with the
+    haversine metric
+
+    Parameters
+    ----------
+    df: pandas DataFrame
+        Observations with latitude, longitude and thickness
+    thickness_min: float
+        Thickness values are bounded below by this value
+    n_neighbors: int, optional
+        Number of nearest neighbours of each site
+    radius_max: float, optional
+        Cutoff radius in km (used if n_neighbors is None)
+    dtype: str or numpy dtype, optional
+        Data type of the affinity matrix
+
+    Returns
+    -------
+    A: scipy sparse matrix
+        Symmetric CSR affinity matrix with shape (nobs,nobs)
+    """
+    X    = np.radians(df[['latitude','longitude']].to_numpy(dtype=float))
+    logy = np.log10(np.maximum(df['thickness'].to_numpy(dtype=float),thickness_min))
+    nobs = len(df)
+    delta1,delta2 = deltas
+
+    tree = BallTree(X,metric='haversine')
+    if n_neighbors is not None:
+        D1,cols = tree.query(X,k=min(n_neighbors+1,nobs))
+        rows = np.repeat(np.arange(nobs),cols.shape[1])
+        D1   = D1.ravel()
+        cols = cols.ravel()
+    elif radius_max is not None:
+        cols,D1 = tree.query_radius(X,r=radius_max/radius,return_distance=True)
+        rows = np.repeat(np.arange(nobs),[len(item) for item in cols])
+        D1   = np.concatenate(D1)
+        cols = np.concatenate(cols)
+    else:
+        raise ValueError("Define the number of neighbours or the cutoff radius")
+    D1 = radius * D1
+    D2 = logy[rows] - logy[cols]
+    a  = np.exp(-0.5 * (D1**2 / delta1**2 + D2**2 / delta2**2))
+
+    A = sparse.csr_matrix((a.astype(dtype),(rows,cols)),shape=(nobs,nobs))
+    #The nearest neighbour relation is not symmetric
+    return A.maximum(A.T).tocsr()
+
+def get_selection(A,nsel):
+    """
+    Greedy selection of the most uncorrelated data. At each
+    step, the observation with the minimum 1-to-N similarity
+    (maximum affinity with the remaining observations) is
+    removed. Row maxima are updated incrementally: only rows
+    whose maximum was found in the removed column are
+    recomputed
+
+    Parameters
+    ----------
+    A: numpy array
+        Affinity matrix with shape (nobs,nobs)
+    nsel: int
+        Number of selection steps
+
+    Returns
+    -------
+    order: numpy array
+        Index of the observation selected at each step.
+        The first n steps give the selection for a
+        subset of size n
+    """
+    nobs  = len(A)
+    A     = np.array(A,dtype=float)
+    valid = np.full(nobs,True)
+    order = np.empty(nsel,dtype=int)
+    #Affinities are positive: removed entries are set to -1
+    np.fill_diagonal(A,-1)
+    imax = np.argmax(A,axis=1)
+    amax = A[np.arange(nobs),imax]
+    for isel in range(nsel):
+        maxAff = np.where(valid,amax,1.0)
+        maxAff[maxAff<0] = 1.0
+        imin = np.argmin(maxAff)
+        order[isel] = imin
+        if not valid[imin]: continue
+        valid[imin] = False
+        A[:,imin]   = -1
+        rows = np.flatnonzero(imax==imin)
+        imax[rows] = np.argmax(A[rows],axis=1)
+        amax[rows] = A[rows,imax[rows]]
+    return order
+
+def get_haversine(lat1,lon1,lat2,lon2):
+    """
+    Vectorized haversine distance in km between
+    points given in radians (broadcasting rules apply)
+    """
+    a = (np.sin(0.5*(lat2-lat1))**2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin(0.5*(lon2-lon1))**2)
+    return 2 * radius * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+
 def log_distance(p1,p2):
     output = math.log10(p1/p2)
     return math.fabs(output)
@@ -2,6 +2,14 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 from scipy import linalg
+from time import perf_counter
+from scipy.spatial import cKDTree
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, dirname, basename
+from obsop import get_ObsOp
+from profiler import Profiler, profile
+from store import write_analysis, write_weights, open_observations
+from ensemble import EnsembleStats, get_anomalies
 
 class AssimilationMethod:
     """
@@ -20,18 +28,30 @@ class AssimilationMethod:
         Ensemble of model states
     y: xarray
         Ensemble of model states in the observation space
+    lazy: bool
+        If x is kept on disk as mass loading and read by tiles
+    max_memory: float
+        Memory budget in bytes for ensemble tiles (None: no limit)
+    incremental: bool
+        If results for a nested observation subset are reused
+        and only the new observations are assimilated
+    profiler: Profiler
+        Stage timers, counters and peak memory samples
 
     Methods
     -------
-    read_ensemble(fname_ens,bulk_density)
+    read_ensemble(fname_ens,bulk_density,lazy=False,dtype=None,max_memory=None)
         Open an ensemble FALL3D output and convert from deposit
         mass loading in kg/m2 to deposit thickness in cm
-    read_observations(fname_obs,random_sort=False)
-        Read observation file with deposit thickness in cm
-    apply_ObsOp()
+    share_ensemble(other)
+        Use the ensemble already read by another instance
+    read_observations(fname_obs,random_sort=False,percentAss=None)
+        Read observation file or store with deposit thickness in cm
+    apply_ObsOp(path_cache=None)
         Apply observation operator
-    to_netcdf(fname_an):
-        Save analysis and forecast to a NetCDF file
+    to_netcdf(fname_an,percentAss=None,sample=None):
+        Save analysis and forecast to a NetCDF file or
+        append them to a consolidated store
     """
 
     methods = ['GNC','GIG','ENKF']
@@ -49,14 +69,23 @@ class AssimilationMethod:
         else:
             self.method = method
 
-        self.df = None
-        self.x  = None
+        self.df    = None
+        self.sites = None
+        self.x     = None
         self.y  = None
         #
         self.xfm = None
         self.xam = None
+        #
+        self.lazy       = False
+        self.max_memory = None
+        self.profiler   = Profiler()
+        #
+        self.incremental = False
+        self._cache      = None
 
-    def read_ensemble(self,fname_ens,bulk_density):
+    @profile('read_ensemble')
+    def read_ensemble(self,fname_ens,bulk_density,lazy=False,dtype=None,max_memory=None):
         """
         Open an ensemble FALL3D output and convert from deposit
         mass loading in kg/m2 to deposit thickness in cm
@@ -67,42 +96,122 @@ class AssimilationMethod:
             The ensemble FALL3D output file 
         bulk_density: float
             The deposit bulk density in kg/m3
+        lazy: bool, optional
+            If the last time slice should be kept on disk and
+            read by tiles when required
+        dtype: str or numpy dtype, optional
+            Data type of the ensemble states (e.g. float32)
+        max_memory: float, optional
+            Memory budget in MB for ensemble tiles
         """
-        ds = xr.open_dataset(fname_ens)
+        ds = xr.open_dataset(fname_ens,cache=not lazy)
+        x  = ds.isel(time=-1)['tephra_grn_load']
         #Convert mass loading (kg/m2) to thickness (cm)
         #using deposit bulk density (kg/m3)
-        fu = 100.0/bulk_density
-        self.x    = fu*ds.isel(time=-1)['tephra_grn_load']
-        self.nens = self.x.sizes['ens']
+        self.fname_ens    = fname_ens
+        self.bulk_density = bulk_density
+        self.fu    = 100.0/bulk_density
+        self.dtype = np.result_type(x.dtype,1.0) if dtype is None else np.dtype(dtype)
+        self.lazy  = lazy
+        self.max_memory = None if not max_memory else 1024**2*max_memory
+        if lazy:
+            self.x = x
+        else:
+            self.x  = x.load().astype(self.dtype,copy=False)
+            self.x *= self.fu
+        self.nens   = self.x.sizes['ens']
+        self.nstate = self.x.size // self.nens
+        self.y      = None
+        self._cache = None
 
-    def read_observations(self,fname_obs,random_sort=False):
+    def share_ensemble(self,other):
+        """
+        Use the ensemble already read by another instance
+
+        Parameters
+        ----------
+        other: AssimilationMethod
+            Instance with an ensemble already read
+        """
+        for key in ['x','fname_ens','bulk_density','fu','dtype','lazy','max_memory','nens','nstate']:
+            setattr(self,key,getattr(other,key))
+        self.y      = None
+        self._cache = None
+
+    @profile('read_observations')
+    def read_observations(self,fname_obs,random_sort=False,percentAss=None):
         """
         Read observation file with deposit thickness in cm
 
         Parameters
         ----------
         fname_obs: str
-            Observation file
+            Observation file (csv) or observation store (npz)
         random_sort: bool, optional
             If observations should be randomly sorted
+        percentAss: int, optional
+            Split of the observation store. Ignored for
+            observation files
         """
-        df = pd.read_csv(fname_obs)
-        df = df[df.dataset=='assimilation']
+        if fname_obs.endswith('.npz'):
+            #Index lookup. Rows are kept in the order of
+            #the observation files
+            obs = open_observations(fname_obs)
+            index,columns = obs.get_split(percentAss)
+            self.sites = obs.sites
+            df = pd.DataFrame(columns,index=index).sort_index()
+        else:
+            df = pd.read_csv(fname_obs)
+            self.sites = df[['latitude','longitude']]
+            df = df[df.dataset=='assimilation']
         if random_sort: df = df.sample(frac=1)
         self.df   = df
         self.nobs = len(df)
+        self.profiler.set('nobs',self.nobs)
 
-    def apply_ObsOp(self):
+    @profile('apply_ObsOp')
+    def apply_ObsOp(self,path_cache=None):
         """
-        Apply observation operator
+        Apply observation operator. In incremental mode, only
+        sites not found in the previous call are interpolated
+
+        Parameters
+        ----------
+        path_cache: str, optional
+            Folder for cached interpolation matrices
         """
         if self.x is None:
             raise TypeError("Read ensemble model state first")
-        lat_obs = xr.DataArray(self.df['latitude'], dims='loc')
-        lon_obs = xr.DataArray(self.df['longitude'],dims='loc')
-        self.y  = self.x.interp(lat=lat_obs,lon=lon_obs)
+        with self.profiler.stage('get_ObsOp'):
+            H = get_ObsOp(self.x['lat'],self.x['lon'],
+                          self.sites['latitude'],
+                          self.sites['longitude'],
+                          dims = self.x.transpose('ens',...).dims[1:],
+                          path = path_cache)
+            H = H.subset(self.sites.index.get_indexer(self.df.index))
+        coords = {key: value for key,value in self.x.coords.items()
+                             if value.dims in [(),('ens',)]}
+        coords['loc'] = self.df.index.to_numpy()
+        coords['lat'] = ('loc',H.lat_obs)
+        coords['lon'] = ('loc',H.lon_obs)
+        self.profiler.set('nens',self.nens)
+        self.profiler.set('nstate',self.nstate)
+        y   = np.empty((self.nens,self.nobs))
+        new = np.full(self.nobs,True)
+        if self.incremental and self.y is not None:
+            y_old = self.y.reindex(loc=coords['loc'])
+            new   = (y_old['lat'].values!=H.lat_obs) | (y_old['lon'].values!=H.lon_obs)
+            y[:,~new] = y_old.transpose('ens','loc').values[:,~new]
+        with self.profiler.stage('interpolate'):
+            if new.any():
+                H = H.subset(np.flatnonzero(new))
+                y[:,new] = H.apply_tiles(self._iter_tiles())
+        self.y = xr.DataArray(y,
+                              dims   = ('ens','loc'),
+                              coords = coords)
 
-    def to_netcdf(self,fname_an):
+    @profile('to_netcdf')
+    def to_netcdf(self,fname_an,percentAss=None,sample=None):
         """
         Save analysis and forecast to a NetCDF file
 
@@ -110,12 +219,136 @@ class AssimilationMethod:
         ----------
         fname_an: str
             Analysis output file
+        percentAss: int, optional
+            If defined, fname_an is a consolidated store and the
+            analysis is appended to the group of the method
+        sample: int, optional
+            Realisation number used in the consolidated store
         """
+        if percentAss is not None:
+            write_analysis(fname_an,self.method,percentAss,self.xfm,self.xam,sample)
+            return
         ds = xr.Dataset()
         ds['forecast'] = self.xfm
         ds['analysis'] = self.xam
         ds.to_netcdf(fname_an)
 
+    def _iter_tiles(self,align=1):
+        """
+        Iterate over spatial tiles of the ensemble states
+        fitting the memory budget. Tiles are built along
+        the first spatial dimension
+
+        Parameters
+        ----------
+        align: int, optional
+            Number of rows in a tile must be a multiple of align
+
+        Yields
+        ------
+        tile: slice
+            Range of the flattened state vector
+        x: numpy array
+            Ensemble states in the tile with shape (nens,ntile).
+            It may be a read-only view of the ensemble
+        """
+        x     = self.x.transpose('ens',...)
+        dim   = x.dims[1]
+        nrow  = x.sizes[dim]
+        ncol  = self.nstate // nrow
+        if self.max_memory is None:
+            step = nrow
+        else:
+            step = int(self.max_memory // (self.nens*ncol*self.dtype.itemsize))
+            step = min(max(step//align*align,align),nrow)
+        for i in range(0,nrow,step):
+            xt = x.isel({dim: slice(i,i+step)}).values
+            if self.lazy:
+                xt = np.multiply(xt,self.fu,dtype=self.dtype)
+            xt = xt.reshape(self.nens,-1)
+            yield slice(i*ncol,i*ncol+xt.shape[1]), xt
+
+    def _iter_members(self):
+        """
+        Iterate over chunks of ensemble members fitting
+        the memory budget
+
+        Yields
+        ------
+        x: numpy array
+            Ensemble states of the chunk with shape (m,nstate).
+            It may be a read-only view of the ensemble
+        """
+        x = self.x.transpose('ens',...)
+        if self.max_memory is None:
+            step = self.nens
+        else:
+            step = int(self.max_memory // (self.nstate*self.dtype.itemsize))
+            step = min(max(step,1),self.nens)
+        for i in range(0,self.nens,step):
+            xt = x.isel(ens=slice(i,i+step)).values
+            if self.lazy:
+                xt = np.multiply(xt,self.fu,dtype=self.dtype)
+            yield xt.reshape(xt.shape[0],-1)
+
+    def _get_stats(self,weights=None):
+        """
+        Compute the forecast mean and weighted sums of the
+        ensemble members in a single pass
+
+        Parameters
+        ----------
+        weights: numpy array, optional
+            Weights of each member with shape (nens,nweights)
+
+        Returns
+        -------
+        stats: EnsembleStats
+            Streaming ensemble statistics
+        """
+        stats = EnsembleStats(self.nstate,weights=weights)
+        for x in self._iter_members():
+            stats.update(x)
+        return stats
+
+    def _get_obs(self):
+        """
+        Return a contiguous copy of the ensemble states in the
+        observation space as a numpy array with shape (nens,nobs)
+        """
+        y = self.y.transpose('ens','loc')
+        return np.array(y.values,order='C')
+
+    def _to_field(self,values):
+        """
+        Build a DataArray on the model grid from a flattened
+        state vector with shape (nstate,)
+        """
+        template = self.x.isel(ens=0,drop=True)
+        return xr.DataArray(
+                np.reshape(values,template.shape),
+                coords = template.coords,
+                dims   = template.dims)
+
+    def _get_nested(self):
+        """
+        Compare the current observations with the ones assimilated
+        in the cached run
+
+        Returns
+        -------
+        new: numpy array
+            Mask of observations not included in the cached run
+            or None if the cached observations are not a subset
+            of the current ones
+        """
+        if self._cache is None: return None
+        df_old = self._cache['df']
+        if not df_old.index.isin(self.df.index).all(): return None
+        columns = ['latitude','longitude','thickness','error','error_r']
+        if not self.df.loc[df_old.index,columns].equals(df_old[columns]): return None
+        return ~self.df.index.isin(df_old.index)
+
     def _check_assimilate(self):
         """
         Check if required variables are defined
@@ -125,111 +358,739 @@ class AssimilationMethod:
         if self.x is None:  raise TypeError("Read ensemble model state first")
 
 class GNC(AssimilationMethod):
-    def __init__(self,max_iterations):
+    solvers = ['multiplicative','squarem']
+
+    def __init__(self,max_iterations,solver='multiplicative',tolerance=0,kkt_tolerance=0,check_inversion=False):
+        """
+        Parameters
+        ----------
+        max_iterations: int
+            Maximum number of multiplicative updates
+        solver: str, optional
+            Use the plain multiplicative update (multiplicative) or
+            the SQUAREM extrapolation of the multiplicative update
+            kept on the nonnegative orthant (squarem)
+        tolerance: float, optional
+            Stop when the relative change of the objective function
+            is below this value (0: not used)
+        kkt_tolerance: float, optional
+            Stop when the scaled KKT residual max|min(w,g/diag(Q))|
+            with g = Q@w+b is below kkt_tolerance*max(w), so the
+            weights are within ~kkt_tolerance of the minimum for
+            both solvers. If 0, stop when a single update changes
+            the weights less than the np.allclose tolerance (only
+            for multiplicative: extrapolated steps pass this test
+            far from the minimum)
+        check_inversion: bool, optional
+            If the pseudo-inverse of the forecast error covariance
+            in the observation space should be checked
+        """
         super().__init__('GNC')
+        if not solver in self.solvers:
+            str_out = "Solver: {} not implemented".format(solver)
+            raise NotImplementedError(str_out)
+        if solver == 'squarem' and not kkt_tolerance > 0:
+            raise ValueError("Solver squarem requires kkt_tolerance > 0")
         self.max_iterations = max_iterations
+        self.solver    = solver
+        self.tolerance = tolerance
+        self.kkt_tolerance = kkt_tolerance
+        self.check_inversion = check_inversion
+        self.info      = None
 
-    def assimilate(self):
+    @profile('assimilate')
+    def assimilate(self,update=True):
+        """
+        Parameters
+        ----------
+        update: bool, optional
+            If the forecast and analysis fields should be
+            computed. Otherwise, only the weights are computed
+        """
+        Q,b = self.get_system()
+
+        ###
+        ### GNC method: solve iterative procedure
+        ### (batch with a single problem)
+        ###
+        W,info = self.solve_batch(Q[None],b[None])
+        self.set_weights(W[0],info[0],update)
+
+    @profile('get_system')
+    def get_system(self):
+        """
+        Build the quadratic problem min 1/2 w.Q.w + b.w
+        (w>=0) for the current observations
+
+        Returns
+        -------
+        Q: numpy array
+            Matrix with shape (nens,nens)
+        b: numpy array
+            Vector with shape (nens,)
+        """
         self._check_assimilate()
-        y = self.y.copy()
-        x = self.x.copy()
-        self.xfm = x.mean(dim='ens')
         debug = True
         ###
         ### GNC method
         ###
-        ym = y.mean(dim='ens')
-        yp = y - ym
         yo = self.df['thickness']
         ye = self.df['error']
-        
+
         ###
         ### Define numpy arrays for linear algebra operations
+        ### with shape (nobs,nens)
         ###
-        hxm = ym.values
+        hx  = self.y.transpose('loc','ens').values
+        hxm, hxp = get_anomalies(self._get_obs())
+        hxp = hxp.T
 
-        if y.get_axis_num("loc") == 0:
-            hx = y.values
-        else:
-            hx = y.values.T
+        ###
+        ### Compute the pseudo-inverse of P = hxp@hxp.T/(nens-1)
+        ### using a thin SVD of the anomalies hxp = U@diag(s)@Vt.
+        ### Eigenvalues of P below the pinvh cutoff are discarded
+        ###
+        with self.profiler.stage('inverse'):
+            U,s,_ = linalg.svd(hxp,full_matrices=False)
+            lam   = s**2/(self.nens-1)
+            rank  = np.count_nonzero(lam > max(hxp.shape[0],1)*np.finfo(lam.dtype).eps*lam.max())
+            U     = U[:,:rank]
+            lam   = lam[:rank]
+            if debug:
+                print("* Checking succesful inversion:")
+                print("  rank/obs: {}/{}".format(rank,self.nobs))
+                if self.check_inversion:
+                    # P@Pi@P = P is equivalent to hxp lying in span(U)
+                    result = np.allclose(hxp, U@(U.T@hxp))
+                    print("  result: {}".format(result))
+        self.profiler.set('gnc.rank',rank)
+
+        # Q = hx.T@(Ri+Pi)@hx
+        # b = -hx.T@(Pi@hxm+Ri@yo)
+        with self.profiler.stage('quadratic_form'):
+            ri = 1.0/ye.to_numpy()
+            G  = U.T@hx
+            Gs = G/np.sqrt(lam)[:,None]
+            Hs = hx*ri[:,None]
+            Q  = Hs.T@Hs + Gs.T@Gs
+            b  = -1*(Hs.T@(ri*yo.to_numpy()) + G.T@((U.T@hxm)/lam))
+        return Q,b
 
-        if yp.get_axis_num("loc") == 0:
-            hxp = yp.values
+    @profile('set_weights')
+    def set_weights(self,w,info=None,update=True):
+        """
+        Compute the forecast and the analysis for the
+        weight factors of the ensemble members
+
+        Parameters
+        ----------
+        w: numpy array
+            Weight factors with shape (nens,)
+        info: dict, optional
+            Solver information (e.g. from solve_batch)
+        update: bool, optional
+            If the forecast and analysis fields should be
+            computed. Otherwise, only the weights are saved
+        """
+        if info is not None: self._set_info(info)
+        self.w = xr.DataArray(w,
+                              dims   = 'ens',
+                              coords = {'ens': self.x['ens'].values})
+        if not update:
+            self.xfm = None
+            self.xam = None
+            return
+        with self.profiler.stage('update'):
+            stats = self._get_stats(w[:,None])
+        self.xfm = self._to_field(stats.mean)
+        self.xam = self._to_field(stats.sums[0])
+
+    @profile('solve')
+    def solve_batch(self,Q,b):
+        """
+        Solve several GNC problems together using batched
+        matrix products. Converged problems are removed from
+        the batch, so the cost is given by the hardest problem.
+        The reported time is the solver time of the whole batch
+
+        Parameters
+        ----------
+        Q: numpy array
+            Stacked matrices with shape (nbatch,nens,nens)
+        b: numpy array
+            Stacked vectors with shape (nbatch,nens)
+
+        Returns
+        -------
+        w: numpy array
+            Weight factors with shape (nbatch,nens)
+        info: list
+            Solver information for each problem
+        """
+        t0 = perf_counter()
+        Q  = np.asarray(Q,dtype=np.float64)
+        b  = np.array(b,dtype=np.float64)
+        if self.solver == 'multiplicative':
+            w,info = self._solve_multiplicative_batch(Q,b)
         else:
-            hxp = yp.values.T
+            w,info = self._solve_squarem_batch(Q,b)
+        time = perf_counter()-t0
+        info = [{'solver':     self.solver,
+                 'iterations': int(info['iterations'][i]),
+                 'residual':   float(info['residual'][i]),
+                 'objective':  float(info['objective'][i]),
+                 'converged':  bool(info['converged'][i]),
+                 'time':       time}
+                for i in range(len(w))]
+        return w,info
 
-        Ri = np.diag(1.0/ye**2)
-        P  = hxp@hxp.T
-        P /= self.nens-1
-        #
-        Pi,rank = linalg.pinvh(P,return_rank=True)
-        if debug:
-            print("* Checking succesful inversion:")
-            print("  rank/obs: {}/{}".format(rank,self.nobs))
-            result = np.allclose(P, np.dot(P, np.dot(Pi,P)))
-            print("  result: {}".format(result))
+    @profile('to_netcdf')
+    def weights_to_netcdf(self,fname_w):
+        """
+        Save the weight factors with a reference to the
+        ensemble file. Fields can be reconstructed using
+        store.reconstruct or store.open_weights
+
+        Parameters
+        ----------
+        fname_w: str
+            Weights output file
+        """
+        write_weights(fname_w,self.w,self.fname_ens,self.bulk_density,
+                      **(self.info or {}))
 
-        Q  = hx.T@(Ri+Pi)@hx
-        b  = -1*hx.T@(Pi@hxm+Ri@yo)
-        Ap = np.abs(Q)+Q
-        An = np.abs(Q)-Q
+    def _set_info(self,info):
+        """
+        Save and report the solver information
+        """
+        debug = True
+        self.info = info
+        self.profiler.set('gnc.iterations',info['iterations'])
+        self.profiler.set('gnc.residual',info['residual'])
+        self.profiler.set('gnc.converged',info['converged'])
 
-        ###
-        ### GNC method: solve iterative procedure
-        ###
-        w = np.full(self.nens,1.0/self.nens) # Weight factors: initial condition
-        for i in range(self.max_iterations):
-            a = Ap@w
-            c = An@w
-            f = (np.sqrt(b**2+a*c)-b)/a
-            if(np.allclose(w*f,w)): break
-            w *= f    
-
-        if debug: print("Finishing at iteration: {}".format(i+1))
-        if i+1==self.max_iterations:
+        if debug:
+            print("Finishing at iteration: {}".format(info['iterations']))
+            print("  residual: {:.3e}".format(info['residual']))
+            print("  time: {:.3f} s".format(info['time']))
+        if not info['converged']:
             print("**WARNING** No convergence achieved")
             print("Increase the number of iterations")
 
-        self.w = xr.DataArray(w,dims='ens')
-        self.xam = x.dot(self.w)
+    @staticmethod
+    def _update_batch(M,b,b2,w,out,ac):
+        """
+        Batched multiplicative update out = w*f(w) for
+        problems with Q = (Ap-An)/2 and M = [Ap;An] computed
+        in place. The products Ap@w and An@w are left in the
+        preallocated buffer ac with shape (nbatch,2*nens)
+        """
+        nens = w.shape[1]
+        np.matmul(M,w[:,:,None],out=ac[:,:,None])
+        a,c = ac[:,:nens],ac[:,nens:]
+        np.multiply(a,c,out=out)
+        out += b2
+        np.sqrt(out,out=out)
+        out -= b
+        out /= a
+        out *= w
+
+    @staticmethod
+    def _get_objective_batch(w,ac,b,buffer):
+        """
+        Objective function 1/2 w.Q.w + b.w for each problem
+        of a batch from the products ac of the last update
+        at w, using a preallocated buffer
+        """
+        nens = w.shape[1]
+        # Q@w = (a-c)/2
+        np.subtract(ac[:,:nens],ac[:,nens:],out=buffer)
+        buffer *= 0.25
+        buffer += b
+        return np.einsum('ij,ij->i',w,buffer)
+
+    @staticmethod
+    def _get_objective_direct(D,b,w,buffer):
+        """
+        Objective function 1/2 w.Q.w + b.w for each problem
+        of a batch with D = 2*Q, using a preallocated buffer
+        """
+        np.matmul(D,w[:,:,None],out=buffer[:,:,None])
+        buffer *= 0.25
+        buffer += b
+        return np.einsum('ij,ij->i',w,buffer)
+
+    @staticmethod
+    def _check_step_batch(w1,w0,buffer,work,rtol=1e-05,atol=1e-08):
+        """
+        Check the np.allclose(w1,w0) condition for each
+        problem of a batch with nonnegative weights using
+        the preallocated buffers buffer and work
+        """
+        np.subtract(w1,w0,out=buffer)
+        np.abs(buffer,out=buffer)
+        np.multiply(w0,rtol,out=work)
+        buffer -= work
+        return buffer.max(axis=1) <= atol
+
+    def _get_kkt_batch(self,w,ac,b,d,buffer):
+        """
+        Scaled KKT residual max|min(w,g/d)|/max(w) for each
+        problem of a batch with gradient g = Q@w+b and
+        d = diag(Q), from the products ac of the last update
+        at w. It vanishes only at the minimum, independently
+        of the step size of the solver
+        """
+        nens = w.shape[1]
+        np.subtract(ac[:,:nens],ac[:,nens:],out=buffer)
+        buffer *= 0.5
+        buffer += b
+        buffer /= d
+        np.minimum(w,buffer,out=buffer)
+        np.abs(buffer,out=buffer)
+        residual = buffer.max(axis=1)/w.max(axis=1)
+        return residual, residual <= self.kkt_tolerance
+
+    def _check_objective_batch(self,J,J_old):
+        """
+        Check the stopping criterion based on the objective
+        function for each problem of a batch. The objective
+        function of the previous step is NaN in the first step
+        """
+        return np.abs(J-J_old) <= self.tolerance*np.abs(J)
+
+    def _get_info_batch(self,nbatch):
+        """
+        Arrays with the solver information of a batch
+        """
+        return {'iterations': np.zeros(nbatch,dtype=int),
+                'residual':   np.zeros(nbatch),
+                'objective':  np.zeros(nbatch),
+                'converged':  np.full(nbatch,False)}
+
+    def _solve_multiplicative_batch(self,Q,b):
+        """
+        Batched multiplicative update iteration using
+        preallocated buffers. Problems are removed from the
+        batch when they converge
+        """
+        nbatch = len(b)
+        info   = self._get_info_batch(nbatch)
+        W      = np.empty((nbatch,self.nens))
+        active = np.arange(nbatch)
+        M      = np.concatenate([np.abs(Q)+Q,np.abs(Q)-Q],axis=1)
+        b2     = b**2
+        d      = self._get_diagonal(Q)
+        w      = np.full((nbatch,self.nens),1.0/self.nens) # Weight factors: initial condition
+        wn,t,u = [np.empty_like(w) for i in range(3)]
+        ac     = np.empty((nbatch,2*self.nens))
+        J_old  = np.full(nbatch,np.nan)
+        for i in range(self.max_iterations):
+            self._update_batch(M,b,b2,w,wn,ac)
+            if self.kkt_tolerance:
+                residual,converged = self._get_kkt_batch(w,ac,b,d,t)
+            else:
+                converged = self._check_step_batch(wn,w,t,u)
+            if self.tolerance:
+                J = self._get_objective_batch(w,ac,b,u)
+                converged |= self._check_objective_batch(J,J_old)
+                J_old = J
+            done = converged if i+1 < self.max_iterations else np.full(len(active),True)
+            if done.any():
+                index = active[done]
+                if not self.kkt_tolerance:
+                    residual = np.abs(wn-w).max(axis=1)
+                info['iterations'][index] = i+1
+                info['residual'][index]   = residual[done]
+                info['objective'][index]  = self._get_objective_batch(w,ac,b,u)[done]
+                info['converged'][index]  = converged[done]
+                W[index] = np.where(converged[done,None],w[done],wn[done])
+                keep = ~done
+                active,J_old = active[keep],J_old[keep]
+                M,b,b2,d,wn = self._compact(keep,M,b,b2,d,wn)
+                w,t,u,ac = [item[:len(active)] for item in (w,t,u,ac)]
+                if not len(active): break
+            w,wn = wn,w
+        return W,info
+
+    def _solve_squarem_batch(self,Q,b):
+        """
+        Batched SQUAREM acceleration of the multiplicative
+        update using preallocated buffers. Extrapolated points
+        are kept on the positive orthant by backtracking the
+        steplength and the objective function is not allowed
+        to increase with respect to the plain two-step update.
+        Convergence is checked with the KKT residual at the
+        stabilized points, since a single extrapolated step
+        can be small far from the minimum. Problems are
+        removed from the batch when they converge
+        """
+        nbatch = len(b)
+        info   = self._get_info_batch(nbatch)
+        W      = np.empty((nbatch,self.nens))
+        active = np.arange(nbatch)
+        Ap     = np.abs(Q)+Q
+        An     = np.abs(Q)-Q
+        M      = np.concatenate([Ap,An],axis=1)
+        D      = Ap-An # 2*Q
+        del Ap,An
+        b2     = b**2
+        d      = self._get_diagonal(Q)
+        w      = np.full((nbatch,self.nens),1.0/self.nens) # Weight factors: initial condition
+        w1,w2,r,v,x,t = [np.empty_like(w) for i in range(6)]
+        ac     = np.empty((nbatch,2*self.nens))
+        niter  = np.zeros(nbatch,dtype=int)
+        J_old  = np.full(nbatch,np.nan)
+        while len(active):
+            self._update_batch(M,b,b2,w,w1,ac)
+            niter += 1
+            if self.tolerance:
+                J = self._get_objective_batch(w,ac,b,t)
+            residual,converged = self._get_kkt_batch(w,ac,b,d,t)
+            if self.tolerance:
+                converged |= self._check_objective_batch(J,J_old)
+                J_old = J
+            done = converged | (niter >= self.max_iterations)
+            if done.any():
+                index = active[done]
+                info['iterations'][index] = niter[done]
+                info['residual'][index]   = residual[done]
+                info['objective'][index]  = self._get_objective_batch(w,ac,b,t)[done]
+                info['converged'][index]  = converged[done]
+                W[index] = w[done]
+                keep = ~done
+                active,niter,J_old,residual = [item[keep] for item in (active,niter,J_old,residual)]
+                M,D,b,b2,d,w,w1 = self._compact(keep,M,D,b,b2,d,w,w1)
+                w2,r,v,x,t,ac = [item[:len(active)] for item in (w2,r,v,x,t,ac)]
+                if not len(active): break
+            #
+            self._update_batch(M,b,b2,w1,w2,ac)
+            niter += 1
+            #
+            np.subtract(w1,w,out=r)
+            np.subtract(w2,w1,out=v)
+            v -= r
+            np.multiply(r,r,out=t)
+            norm_r = np.sqrt(t.sum(axis=1))
+            np.multiply(v,v,out=t)
+            norm_v = np.sqrt(t.sum(axis=1))
+            ratio  = np.divide(norm_r,norm_v,out=np.ones_like(norm_r),where=norm_v>0)
+            alpha  = -np.maximum(ratio,1.0)
+            while True:
+                # w - 2*alpha*r + alpha**2*v
+                np.multiply(v,(alpha**2)[:,None],out=x)
+                np.multiply(r,(2*alpha)[:,None],out=t)
+                x -= t
+                x += w
+                if x.min() > 0: break
+                valid = (alpha == -1.0) | (x.min(axis=1) > 0)
+                if valid.all(): break
+                alpha = np.where(valid,alpha,0.5*(alpha-1.0))
+                alpha = np.where(~valid & (alpha>-1.01),-1.0,alpha)
+            #
+            # Stabilization step from the extrapolated points
+            ext = alpha != -1.0
+            if ext.any():
+                self._update_batch(M,b,b2,x,w,ac)
+                Jp = self._get_objective_batch(x,ac,b,t)
+                # Objective function at w2
+                J2 = self._get_objective_direct(D,b,w2,t)
+                np.copyto(w,w2,where=(~ext | (Jp>J2))[:,None])
+                niter[ext] += 1
+            else:
+                w,w2 = w2,w
+            #
+            # Problems reaching the maximum number of iterations
+            done = niter >= self.max_iterations
+            if done.any():
+                index = active[done]
+                info['iterations'][index] = niter[done]
+                info['residual'][index]   = residual[done]
+                info['objective'][index]  = self._get_objective_direct(D,b,w,t)[done]
+                W[index] = w[done]
+                keep = ~done
+                active,niter,J_old = [item[keep] for item in (active,niter,J_old)]
+                M,D,b,b2,d,w = self._compact(keep,M,D,b,b2,d,w)
+                w1,w2,r,v,x,t,ac = [item[:len(active)] for item in (w1,w2,r,v,x,t,ac)]
+        return W,info
+
+    @staticmethod
+    def _get_diagonal(Q):
+        """
+        Diagonal of each matrix of a batch used to scale the
+        gradient in the KKT residual (1 for null members)
+        """
+        d = np.diagonal(Q,axis1=1,axis2=2).copy()
+        d[d<=0] = 1.0
+        return d
+
+    @staticmethod
+    def _compact(keep,*items):
+        """
+        Move the problems kept in a batch to the leading rows
+        of the preallocated buffers
+
+        Returns
+        -------
+        items: list
+            Views of the leading rows of the buffers
+        """
+        n = int(keep.sum())
+        for item in items:
+            item[:n] = item[keep]
+        return [item[:n] for item in items]
 
 class GIG(AssimilationMethod):
-    def __init__(self,thickness_min):
+    def __init__(self,thickness_min,nsample=None,seed=None,incremental=False,tile_size=4096,max_workers=1):
+        """
+        Parameters
+        ----------
+        thickness_min: float
+            Minimum thickness in cm used for zero-thickness observations
+        nsample: int, optional
+            Number of realisations computed in a single pass. If None,
+            a single realisation is computed using the global numpy
+            random state
+        seed: int, optional
+            Seed used to spawn an independent random generator for
+            each realisation (only used if nsample is defined)
+        incremental: bool, optional
+            If the analysis ensembles and the sweep increments of
+            the previous call should be kept to continue the sweep
+            when the observations are a superset of the previous
+            ones. New observations are processed after the cached
+            ones and the random generators are not restarted
+        tile_size: int, optional
+            Number of grid points in the tiles of the state update
+        max_workers: int, optional
+            Number of threads used for the tiles of the state update
+        """
         super().__init__('GIG')
         self.thickness_min = thickness_min
+        self.nsample = nsample
+        self.seed    = seed
+        self.incremental = incremental
+        self.tile_size   = tile_size
+        self.max_workers = max_workers
 
+    @profile('assimilate')
     def assimilate(self):
         self._check_assimilate()
-        y = self.y.copy()
-        x = self.x.copy()
-        self.xfm = x.mean(dim='ens')
+        new = self._get_nested() if self.incremental else None
+        if new is None:
+            if self.nsample is None:
+                rngs = [np.random]
+            else:
+                ss   = np.random.SeedSequence(self.seed)
+                rngs = [np.random.default_rng(s) for s in ss.spawn(self.nsample)]
+            new = np.full(self.nobs,True)
+            d0  = np.empty((len(rngs),0,self.nens))
+            dy0 = np.empty((len(rngs),0,self.nens))
+            xa  = None
+        else:
+            ### Continue the cached run: observations already
+            ### assimilated keep their order and go first
+            rngs = self._cache['rngs']
+            d0   = self._cache['d']
+            dy0  = self._cache['dy']
+            xa   = self._cache['x']
+            self.df = pd.concat([self.df.loc[self._cache['df'].index],self.df[new]])
+            self.y  = self.y.sel(loc=self.df.index)
+            new = np.arange(self.nobs) >= d0.shape[1]
+        nsample = len(rngs)
+        df      = self.df[new]
+        self.profiler.set('incremental.new_obs',len(df))
         ###
         ### GIG method (sequential form)
         ###
-        for index,row in self.df.iterrows():
-            yo  = row["thickness"]
-            R1  = row["error_r"]**2  #type 1 relative observation error variance
+        ### The sequential sweep is performed in the observation
+        ### space first and the resulting rank-1 updates are then
+        ### applied to the ensemble states. The state update is
+        ### independent of the state itself, so both passes give
+        ### the same analysis as a joint sweep over (x,y).
+        ###
+        y = np.array(self.y.sel(loc=df.index).transpose('ens','loc').values,order='C')
+        y = np.stack([y]*nsample)
+        with self.profiler.stage('sweep'):
+            self._replay(y,d0,dy0)
+            d, dy = self._sweep(y,rngs,df)
+        self.profiler.set('gig.nsample',nsample)
+        self.profiler.set('gig.observations',nsample*len(df))
+        ###
+        ### The state update is independent for each grid point,
+        ### so tiles are updated by a pool of threads (BLAS and
+        ### numpy kernels release the GIL)
+        ###
+        xfm = np.empty(self.nstate)
+        xam = np.empty((nsample,self.nstate))
+        restart = xa is None
+        if self.incremental and restart:
+            xa = np.empty((nsample,self.nens,self.nstate),dtype=self.dtype)
+
+        def update(isample,tile,xf):
+            x = np.array(xf if restart else xa[isample,:,tile],order='C')
+            self._update(x,d[isample],dy[isample])
+            if self.incremental: xa[isample,:,tile] = x
+            xam[isample,tile] = x.mean(axis=0,dtype=np.float64)
+
+        with self.profiler.stage('update'), \
+             ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for tile,xf in self._iter_tiles():
+                xfm[tile] = xf.mean(axis=0,dtype=np.float64)
+                jobs = [executor.submit(update,
+                                        isample,
+                                        slice(tile.start+i,min(tile.start+i+self.tile_size,tile.stop)),
+                                        xf[:,i:i+self.tile_size])
+                        for i in range(0,xf.shape[1],self.tile_size)
+                        for isample in range(nsample)]
+                for job in jobs: job.result()
+                self.profiler.add('gig.tiles',len(jobs))
+        if self.incremental:
+            self._cache = {'df':   self.df,
+                           'rngs': rngs,
+                           'd':    np.concatenate([d0,d],axis=1),
+                           'dy':   np.concatenate([dy0,dy],axis=1),
+                           'x':    xa}
+        self.xfm = self._to_field(xfm)
+        if self.nsample is None:
+            self.xam = self._to_field(xam[0])
+        else:
+            self.xam = xr.concat([self._to_field(v) for v in xam],dim='sample')
+            self.xam['sample'] = np.arange(1,nsample+1)
+
+    def to_netcdf(self,fname_an,split=False,percentAss=None,sample=None):
+        """
+        Save analysis and forecast to a NetCDF file
+
+        Parameters
+        ----------
+        fname_an: str
+            Analysis output file
+        split: bool, optional
+            If realisations should be saved in different files
+            using the path/NNN/fname layout (NNN=sample)
+        percentAss: int, optional
+            If defined, fname_an is a consolidated store and all
+            the realisations are appended to the GIG group
+        sample: int, optional
+            Realisation number used in the consolidated store
+            for single realisations
+        """
+        if not split or self.nsample is None or percentAss is not None:
+            super().to_netcdf(fname_an,percentAss=percentAss,sample=sample)
+            return
+        path  = dirname(fname_an)
+        fname = basename(fname_an)
+        with self.profiler.stage('to_netcdf'):
+            for sample in self.xam.sample.values:
+                ds = xr.Dataset()
+                ds['forecast'] = self.xfm
+                ds['analysis'] = self.xam.sel(sample=sample,drop=True)
+                ds.to_netcdf(join(path,"{:03d}".format(sample),fname))
+
+    def _sweep(self,y,rngs,df):
+        """
+        Sequential assimilation in the observation space
+
+        Parameters
+        ----------
+        y: numpy array
+            Ensemble in the observation space with shape
+            (nsample,nens,nobs). It is updated in place
+        rngs: list
+            Random generators for each realisation
+        df: pandas DataFrame
+            Observations with thickness and relative errors
+
+        Returns
+        -------
+        d: numpy array
+            Scaled forecast anomalies cov(.,yf)/var(yf) kernels for
+            each observation with shape (nsample,nobs,nens)
+        dy: numpy array
+            Increments ya-yf for each observation with shape
+            (nsample,nobs,nens)
+        """
+        nsample,nens,nobs = y.shape
+        d  = np.empty((nsample,nobs,nens))
+        dy = np.empty((nsample,nobs,nens))
+        thickness = df['thickness'].to_numpy()
+        error_r   = df['error_r'].to_numpy()
+        for iobs in range(nobs):
+            yo  = np.full(nsample,thickness[iobs])
+            R1  = error_r[iobs]**2   #type 1 relative observation error variance
             R2  = 1./(1./R1+1)       #type 2 relative observation error variance
             #
-            if yo==0: yo = self.thickness_min*np.random.uniform()
+            yf  = y[:,:,iobs].copy()
+            yfm = yf.mean(axis=1,keepdims=True)
+            yfp = yf - yfm
+            P   = np.sum(yfp**2,axis=1,keepdims=True)/nens
+            P2  = P/(P+yfm**2)       #type 2 relative forecast error variance
             #
-            yf  = y.sel(loc=index)
-            yfm = yf.mean()
-            P   = yf.var()
-            P1  = P/yfm**2         #type 1 relative forecast error variance
-            P2  = P/(P+yfm**2)     #type 2 relative forecast error variance
+            yg  = np.empty_like(yf)
+            for isample,rng in enumerate(rngs):
+                if yo[isample]==0: yo[isample] = self.thickness_min*rng.uniform()
+                yg[isample] = self.__get_Gamma(yo[isample],R2,nens,rng)
+            yo  = yo[:,None]
             #
             yam = self.__get_AnMean(yfm,yo,P2,R2)
-            ya  = yam * (1 + self.__get_AnPerturbation(yf,yfm,yo,P2,R2))
+            ya  = yam * (1 + self.__get_AnPerturbation(yf,yfm,yo,P2,R2,yg))
             #
-            dx  = xr.cov(x,yf,dim='ens') / P
-            x  += dx*(ya-yf)
-            x   = x.where(x>0,0)
+            # cov(.,yf) is computed as yfp@(.)/(nens-1)
+            d[:,iobs]  = yfp / ((nens-1)*P)
+            dy[:,iobs] = ya - yf
             #
-            dy  = xr.cov(y,yf,dim='ens') / P
-            y  += dy*(ya-yf)
-            y   = y.where(y>0,0)
-        self.xam = x.mean(dim='ens').drop('loc')
+            dx = np.matmul(d[:,iobs,None,:],y)
+            y += dy[:,iobs,:,None]*dx
+            np.fmax(y,0,out=y)
+        return d, dy
+
+    @staticmethod
+    def _replay(y,d,dy):
+        """
+        Apply the increments of a previous sweep to new
+        columns of the ensemble in the observation space
+
+        Parameters
+        ----------
+        y: numpy array
+            Ensemble in the observation space with shape
+            (nsample,nens,nobs). It is updated in place
+        d: numpy array
+            Scaled anomalies with shape (nsample,nsteps,nens)
+        dy: numpy array
+            Increments with shape (nsample,nsteps,nens)
+        """
+        for istep in range(d.shape[1]):
+            dx = np.matmul(d[:,istep,None,:],y)
+            y += dy[:,istep,:,None]*dx
+            np.fmax(y,0,out=y)
+
+    @staticmethod
+    def _update(x,d,dy):
+        """
+        Apply a sequence of rank-1 updates in place:
+        x += outer(dy,d@x) and remove negative values.
+        The BLAS ger routine is used on the transposed
+        (Fortran-ordered) view to avoid temporary arrays.
+        Increments are computed in the precision of x
+
+        Parameters
+        ----------
+        x: numpy array
+            Ensemble array with shape (nens,n)
+        d: numpy array
+            Scaled anomalies with shape (nsteps,nens)
+        dy: numpy array
+            Increments with shape (nsteps,nens)
+        """
+        ger = linalg.get_blas_funcs('ger',(x,))
+        d   = d.astype(x.dtype,copy=False)
+        dy  = dy.astype(x.dtype,copy=False)
+        for di,dyi in zip(d,dy):
+            dx = di @ x
+            ger(1.0,dx,dyi,a=x.T,overwrite_a=True)
+            np.fmax(x,0,out=x)
 
     @staticmethod
     def __get_AnMean(yfm,yo,p2,r2):
@@ -239,13 +1100,18 @@ class GIG(AssimilationMethod):
         return y
 
     @staticmethod
-    def __get_AnPerturbation(yf,yfm,yo,p2,r2):
+    def __get_Gamma(yo,r2,nens,rng):
         yg1 = r2/(1+2*r2)
         yg_mean = (1+2*r2)*yo
-        yg_var  = yg1*yg_mean**2
         k = 1.0/yg1
         theta = yg_mean*yg1
-        yg = np.random.gamma(k,theta,size=yf.sizes['ens'])
+        return rng.gamma(k,theta,size=nens)
+
+    @staticmethod
+    def __get_AnPerturbation(yf,yfm,yo,p2,r2,yg):
+        yg1 = r2/(1+2*r2)
+        yg_mean = (1+2*r2)*yo
+        yg_var  = yg1*yg_mean**2
         #
         a_coeff = np.sqrt(1-p2)/yfm 
         b_coeff = p2/(p2+r2)
@@ -255,40 +1121,240 @@ class GIG(AssimilationMethod):
         return output
 
 class ENKF(AssimilationMethod):
-    def __init__(self):
+    solvers = ['gain','ensemble']
+    tapers  = ['gaspari_cohn','boxcar']
+
+    def __init__(self,solver='gain',radius=None,taper='gaspari_cohn',tile_size=8,max_workers=1,incremental=False):
+        """
+        Parameters
+        ----------
+        solver: str, optional
+            Use the Kalman gain in the observation space (gain)
+            or the equivalent ETKF-like update in the ensemble
+            space (ensemble)
+        radius: float, optional
+            Localization cutoff radius in km. If defined, a local
+            ensemble-space update is performed for each tile using
+            only the observations within this radius
+        taper: str, optional
+            Localization function applied to the inverse observation
+            error variances (gaspari_cohn or boxcar)
+        tile_size: int, optional
+            Number of grid points per side of local analysis tiles
+        max_workers: int, optional
+            Number of threads used for local analysis tiles
+        incremental: bool, optional
+            If the ensemble-space system S@S.T and S@d of the
+            previous call should be reused when the observations
+            are a superset of the previous ones. Only the global
+            update is supported
+        """
         super().__init__('ENKF')
+        if not solver in self.solvers:
+            str_out = "Solver: {} not implemented".format(solver)
+            raise NotImplementedError(str_out)
+        if not taper in self.tapers:
+            str_out = "Taper: {} not implemented".format(taper)
+            raise NotImplementedError(str_out)
+        if incremental and radius:
+            str_out = "Incremental mode not implemented for localization"
+            raise NotImplementedError(str_out)
+        self.solver      = solver
+        self.radius      = radius
+        self.taper       = taper
+        self.tile_size   = tile_size
+        self.max_workers = max_workers
+        self.incremental = incremental
 
+    @profile('assimilate')
     def assimilate(self):
         self._check_assimilate()
-        y = self.y.copy()
-        x = self.x.copy()
-        self.xfm = x.mean(dim='ens')
         ###
         ### EnKF method
         ###
-        ym = y.mean(dim='ens')
-        xm = x.mean(dim='ens')
-        yp = y - ym
-        xp = x - xm
+        ym, yp = get_anomalies(self._get_obs())
 
-        y_mean    = ym.values
-        x_mean    = xm.stack(z=("lat", "lon")).values
-        y_perturb = yp.values.T
-        x_perturb = xp.stack(z=("lat", "lon")).values.T
+        yo = self.df['thickness'].to_numpy()
+        ye = self.df['error'].to_numpy()
 
-        yo = self.df['thickness']
-        ye = self.df['error']
-        R  = np.diag(ye**2)
+        if self.radius:
+            self._assimilate_local(yp,(yo-ym)/ye,1.0/ye)
+            return
+        with self.profiler.stage('solve'):
+            if self.incremental:
+                w = self._get_weights_incremental(yp/ye,(yo-ym)/ye)
+            elif self.solver == 'gain':
+                R = np.diag(ye**2)
+                # Compute the Kalman gain matrix in the ensemble space:
+                # K@(yo-ym) = xp@w
+                w = yp @ np.linalg.inv(yp.T @ yp + (self.nens-1)*R) @ (yo - ym)
+            else:
+                w = self._get_weights(yp/ye,(yo-ym)/ye)
+
+        # Update the analysis state (posterior):
+        # xa = xm + xp@w = x@(1/nens + w - mean(w))
+        with self.profiler.stage('update'):
+            stats = self._get_stats((1.0/self.nens + w - w.mean())[:,None])
+            xam   = stats.sums[0]
+            xam[xam<0] = 0.0
+        #
+        self.xfm = self._to_field(stats.mean)
+        self.xam = self._to_field(xam)
+
+    def _get_weights(self,S,d):
+        """
+        Solve the ensemble-space system
+        w = (S@S.T + (nens-1)I)^-1 S@d
+
+        Parameters
+        ----------
+        S: numpy array
+            Anomalies scaled by the observation errors yp@R^-1/2
+            with shape (nens,nobs)
+        d: numpy array
+            Innovations scaled by the observation errors
+            R^-1/2(yo-ym) with shape (nobs,)
+        """
+        A = S @ S.T
+        A[np.diag_indices_from(A)] += self.nens-1
+        return linalg.cho_solve(linalg.cho_factor(A), S @ d)
 
-        # Compute the Kalman gain matrix
-        k = x_perturb @ y_perturb.T @ np.linalg.inv(y_perturb @ y_perturb.T + (self.nens-1)*R)
+    def _get_weights_incremental(self,S,d):
+        """
+        Solve the ensemble-space system for w as in _get_weights,
+        adding only the contribution of new observations to the
+        cached S@S.T and S@d of the previous call
 
-        # Update the analysis state (posterior)
-        xa = x_mean + k @ (yo - y_mean)
-        xa[xa<0] = 0.0
+        Parameters
+        ----------
+        S: numpy array
+            Anomalies scaled by the observation errors yp@R^-1/2
+            with shape (nens,nobs)
+        d: numpy array
+            Innovations scaled by the observation errors
+            R^-1/2(yo-ym) with shape (nobs,)
+        """
+        new = self._get_nested()
+        if new is None:
+            new = np.full(self.nobs,True)
+            A   = np.zeros((self.nens,self.nens))
+            g   = np.zeros(self.nens)
+        else:
+            A = self._cache['A']
+            g = self._cache['g']
+        A = A + S[:,new] @ S[:,new].T
+        g = g + S[:,new] @ d[new]
+        self._cache = {'df': self.df, 'A': A, 'g': g}
+        self.profiler.set('incremental.new_obs',np.count_nonzero(new))
         #
-        coords = xm.stack(z=("lat","lon")).coords
-        self.xam = xr.DataArray(xa,coords=coords).unstack("z")
+        A = A.copy()
+        A[np.diag_indices_from(A)] += self.nens-1
+        return linalg.cho_solve(linalg.cho_factor(A), g)
+
+    def _assimilate_local(self,yp,d,ri):
+        """
+        Localized ensemble-space update performed by tiles.
+        For each tile, observations within the cutoff radius
+        are found using a KD-tree and their inverse error
+        standard deviations are tapered by the distance to
+        the tile centre
+
+        Parameters
+        ----------
+        yp: numpy array
+            Anomalies in the observation space with shape (nens,nobs)
+        d: numpy array
+            Scaled innovations R^-1/2(yo-ym) with shape (nobs,)
+        ri: numpy array
+            Inverse observation error standard deviations R^-1/2
+        """
+        tree  = cKDTree(_to_xyz(self.df['latitude'].to_numpy(),
+                                self.df['longitude'].to_numpy()))
+        x     = self.x.transpose('ens',...)
+        dims  = x.dims[1:]
+        ncol  = x.sizes[dims[1]]
+        coord = [x[dim].to_numpy() for dim in dims]
+        ilat  = dims.index('lat')
+        n     = self.tile_size
+
+        def update(x,c0,c1,xfm,xam):
+            lat,lon = (c0,c1) if ilat==0 else (c1,c0)
+            centre  = _to_xyz(np.mean(lat),np.mean(lon))
+            iobs    = tree.query_ball_point(centre,_to_chord(self.radius))
+            xm = x.mean(axis=0,dtype=np.float64)
+            xfm[:] = xm
+            if iobs:
+                iobs  = np.array(iobs)
+                dist  = _to_distance(np.linalg.norm(tree.data[iobs]-centre,axis=1))
+                taper = np.sqrt(self._get_taper(dist))
+                w = self._get_weights(yp[:,iobs]*(taper*ri[iobs]),taper*d[iobs])
+                xa = xm + np.tensordot(w,x,axes=1) - xm*w.sum()
+                xam[:] = np.where(xa>0,xa,0)
+            else:
+                xam[:] = np.where(xm>0,xm,0)
+            return len(iobs)
+
+        xfm = np.empty(self.nstate)
+        xam = np.empty(self.nstate)
+        with self.profiler.stage('local_update'), \
+             ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for tile,xt in self._iter_tiles(align=n):
+                i0   = tile.start // ncol
+                nrow = xt.shape[1] // ncol
+                xt   = xt.reshape(self.nens,nrow,ncol)
+                xfmt = xfm[tile].reshape(nrow,ncol)
+                xamt = xam[tile].reshape(nrow,ncol)
+                jobs = [executor.submit(update,
+                                        xt[:,i:i+n,j:j+n],
+                                        coord[0][i0+i:i0+i+n],
+                                        coord[1][j:j+n],
+                                        xfmt[i:i+n,j:j+n],
+                                        xamt[i:i+n,j:j+n])
+                        for i in range(0,nrow,n) for j in range(0,ncol,n)]
+                nobs = [job.result() for job in jobs]
+                self.profiler.add('enkf.local_tiles',len(jobs))
+                self.profiler.add('enkf.local_obs',sum(nobs))
+        #
+        self.xfm = self._to_field(xfm)
+        self.xam = self._to_field(xam)
+
+    def _get_taper(self,dist):
+        """
+        Localization function for distances in km
+        """
+        if self.taper == 'boxcar':
+            return (dist<=self.radius).astype(float)
+        #Gaspari-Cohn function with support radius
+        r = np.minimum(2*dist/self.radius,2)
+        taper = np.where(r<=1,
+                         1 - 5/3*r**2 + 5/8*r**3 + 1/2*r**4 - 1/4*r**5,
+                         4 - 5*r + 5/3*r**2 + 5/8*r**3 - 1/2*r**4 + 1/12*r**5 - 2/(3*np.maximum(r,1)))
+        return np.clip(taper,0,1)
+
+def _to_xyz(lat,lon):
+    """
+    Convert latitude and longitude in degrees to
+    unit vectors
+    """
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    return np.stack([np.cos(lat)*np.cos(lon),
+                     np.cos(lat)*np.sin(lon),
+                     np.sin(lat)],axis=-1)
+
+def _to_chord(dist,radius=6371.0):
+    """
+    Convert great-circle distances in km to chord
+    lengths on the unit sphere
+    """
+    return 2*np.sin(0.5*dist/radius)
+
+def _to_distance(chord,radius=6371.0):
+    """
+    Convert chord lengths on the unit sphere to
+    great-circle distances in km
+    """
+    return 2*radius*np.arcsin(np.minimum(0.5*chord,1))
 
 if __name__ == '__main__':
     x = ENKF()
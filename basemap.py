@@ -0,0 +1,204 @@
+import numpy as np
+import xarray as xr
+from os.path import isfile
+from matplotlib.path import Path
+from matplotlib.collections import PathCollection
+from configparser import ConfigParser
+
+###
+### Geometry layers of the basemap. Layers are clipped to
+### the model domain, simplified for each zoom level and
+### saved as flat coordinate arrays
+###
+layers = {'land':     {'facecolor': 'lightgrey',
+                       'edgecolor': 'none',
+                       'alpha':     0.8,
+                       'zorder':    0},
+          'borders':  {'facecolor': 'none',
+                       'edgecolor': 'gray',
+                       'linewidth': 0.4},
+          'isopachs': {'facecolor': 'none',
+                       'edgecolor': 'k',
+                       'linewidth': 1,
+                       'alpha':     0.5},
+          }
+
+def build_basemap(fname,extent,tolerances,fname_sh=None,scale='10m'):
+    """
+    Build the basemap cache from Natural Earth borders and
+    land polygons and the isopach shapefile. Natural Earth
+    files are only downloaded if they are not found in the
+    cartopy data folder
+
+    Parameters
+    ----------
+    fname: str
+        Basemap cache file (npz)
+    extent: list
+        Domain [lon_min,lon_max,lat_min,lat_max]
+    tolerances: list
+        Simplification tolerance in degrees of each zoom
+        level (0: no simplification)
+    fname_sh: str, optional
+        Isopach shapefile
+    scale: str, optional
+        Natural Earth scale
+    """
+    #Only required to build the cache
+    import shapely
+    import cartopy.io.shapereader as shpreader
+
+    sources = {'land':    shpreader.natural_earth(resolution=scale,
+                                                  category='physical',
+                                                  name='land'),
+               'borders': shpreader.natural_earth(resolution=scale,
+                                                  category='cultural',
+                                                  name='admin_0_boundary_lines_land')}
+    if fname_sh: sources['isopachs'] = fname_sh
+    box  = shapely.box(extent[0],extent[2],extent[1],extent[3])
+    data = {'extent': np.array(extent), 'tolerances': np.array(tolerances)}
+    for layer,fname_shp in sources.items():
+        geoms = [geom.intersection(box) for geom in shpreader.Reader(fname_shp).geometries()
+                                        if geom.intersects(box)]
+        for level,tolerance in enumerate(tolerances):
+            if tolerance > 0:
+                items = [geom.simplify(tolerance,preserve_topology=True) for geom in geoms]
+            else:
+                items = geoms
+            for key,value in _to_arrays(items).items():
+                data["{}_{}_{}".format(layer,level,key)] = value
+    np.savez(fname,**data)
+
+def load_basemap(fname):
+    """
+    Read the basemap cache into memory
+
+    Returns
+    -------
+    data: dict
+        Flat coordinate arrays of each layer and zoom level
+    """
+    if not isfile(fname):
+        raise FileNotFoundError("Basemap cache not found: {}. Run basemap.py first".format(fname))
+    with np.load(fname) as f:
+        return dict(f)
+
+def get_paths(data,layer,level):
+    """
+    Build matplotlib paths of a layer. Rings of the same
+    polygon (exterior and holes) form a compound path
+    """
+    key     = "{}_{}_".format(layer,level)
+    coords  = data[key+'coords']
+    offsets = data[key+'offsets']
+    groups  = data[key+'groups']
+    closed  = data[key+'closed']
+    paths   = {}
+    for i,(i0,i1) in enumerate(zip(offsets[:-1],offsets[1:])):
+        paths.setdefault(groups[i],[]).append(Path(coords[i0:i1],closed=bool(closed[i])))
+    return [Path.make_compound_path(*items) for items in paths.values()]
+
+def get_level(ax,tolerances,dpi=200):
+    """
+    Coarsest zoom level with a simplification tolerance
+    below the pixel size of an axis in the saved figure
+    """
+    x0,x1 = ax.get_xlim()
+    width = ax.get_window_extent().width * dpi/ax.figure.dpi
+    pixel = abs(x1-x0)/max(width,1)
+    return int(np.flatnonzero(np.asarray(tolerances)<=pixel).max())
+
+def draw_basemap(ax,data,level=None,layer_list=('land','borders'),dpi=200):
+    """
+    Draw basemap layers on a map axis with PlateCarree
+    projection. Geometries are given in lon/lat, so no
+    reprojection is required
+
+    Parameters
+    ----------
+    ax: matplotlib axis
+        Map axis
+    data: dict
+        Basemap cache (see load_basemap)
+    level: int, optional
+        Zoom level. If None, the level is selected
+        using the pixel size of the axis
+    layer_list: list, optional
+        Layers to be drawn (land, borders or isopachs)
+    dpi: float, optional
+        Resolution of the saved figure
+    """
+    if level is None: level = get_level(ax,data['tolerances'],dpi)
+    for layer in layer_list:
+        collection = PathCollection(get_paths(data,layer,level),**layers[layer])
+        ax.add_collection(collection,autolim=False)
+
+def _to_arrays(geoms):
+    """
+    Flatten geometries into rings
+
+    Returns
+    -------
+    arrays: dict
+        coords (float32 lon/lat of all the rings), offsets
+        (start of each ring), groups (polygon or line index
+        of each ring) and closed (polygon rings)
+    """
+    coords, offsets, groups, closed = [], [0], [], []
+    for igeom,geom in enumerate(_iter_parts(geoms)):
+        if geom.geom_type == 'Polygon':
+            rings = [geom.exterior,*geom.interiors]
+        elif geom.geom_type in ['LineString','LinearRing']:
+            rings = [geom]
+        else:
+            continue
+        for ring in rings:
+            xy = np.asarray(ring.coords,dtype=np.float32)[:,:2]
+            if len(xy) < 2: continue
+            coords.append(xy)
+            offsets.append(offsets[-1]+len(xy))
+            groups.append(igeom)
+            closed.append(geom.geom_type=='Polygon')
+    return {'coords':  np.concatenate(coords) if coords else np.empty((0,2),dtype=np.float32),
+            'offsets': np.array(offsets),
+            'groups':  np.array(groups,dtype=int),
+            'closed':  np.array(closed,dtype=bool)}
+
+def _iter_parts(geoms):
+    """
+    Iterate over single-part geometries
+    """
+    for geom in geoms:
+        if hasattr(geom,'geoms'):
+            yield from _iter_parts(geom.geoms)
+        elif not geom.is_empty:
+            yield geom
+
+if __name__ == '__main__':
+    ###
+    ### Read configuration file
+    ###
+    config = ConfigParser(inline_comment_prefixes="#")
+    config.read('config.ini')
+
+    ###
+    ### Parameters
+    ###
+    block           = 'DEFAULT'
+    fname_ens       = config.get(block,'fname_ens')
+    fname_sh        = config.get(block,'fname_sh')
+    fname_basemap   = config.get(block,'fname_basemap')
+    tolerances      = [float(item) for item in config.get(block,'simplify').split()]
+    margin          = 1.0
+    debug           = True
+
+    ###
+    ### Domain of the model grid
+    ###
+    if debug: print("Opening simulation output file: {}".format(fname_ens))
+    with xr.open_dataset(fname_ens) as ds:
+        extent = [float(ds.lon.min())-margin, float(ds.lon.max())+margin,
+                  float(ds.lat.min())-margin, float(ds.lat.max())+margin]
+
+    if debug: print("Building basemap cache: {}".format(fname_basemap))
+    build_basemap(fname_basemap,extent,tolerances,fname_sh)
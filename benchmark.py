@@ -0,0 +1,380 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import tracemalloc
+import subprocess
+import sys
+from time import perf_counter
+from os import makedirs
+from os.path import join, isfile
+from sweep import get_method
+from assimilation import ENKF, GIG, GNC
+from configparser import ConfigParser
+
+###
+### Read configuration file
+###
+config = ConfigParser(inline_comment_prefixes="#")
+config.read('config.ini')
+
+###
+### Parameters
+###
+block           = 'BENCH'
+path            = config.get(block,'path')
+methods         = config.get(block,'methods').split()
+list_nens       = [int(item) for item in config.get(block,'nens').split()]
+list_nobs       = [int(item) for item in config.get(block,'nobs').split()]
+list_grid       = [tuple(int(n) for n in item.split('x')) for item in config.get(block,'grid').split()]
+seed            = config.getint(block,'seed')
+checks          = config.getboolean(block,'checks')
+fname_results   = config.get(block,'fname_results')
+bulk_density    = config.getfloat(block,'bulk_density')
+thickness_min   = config.getfloat(block,'thickness_min')
+relative_error  = config.getfloat('DATA','relative_error')
+n_clusters      = config.getint('DATA','n_clusters')
+lazy_loading    = config.getboolean(block,'lazy_loading')
+max_memory      = config.getfloat(block,'max_memory')
+precision       = config.get(block,'precision')
+path_cache      = config.get(block,'path_cache')
+random_sort     = {'GNC': False, 'GIG': True, 'ENKF': False}
+tolerances      = {'GNC': 1E-5, 'GIG': 1E-5, 'ENKF': 1E-6}
+kkt_tolerance   = 1E-7
+debug           = True
+
+###
+### Synthetic FALL3D-like inputs
+###
+lat_range = (-44.0,-34.0)
+lon_range = (-76.0,-60.0)
+vent      = (-41.33,-72.62)
+
+def get_plume(lat,lon,params):
+    """
+    Deposit load of an idealised plume elongated
+    downwind from the vent
+
+    Parameters
+    ----------
+    lat: numpy array
+        Latitude of grid points or sites
+    lon: numpy array
+        Longitude of grid points or sites
+    params: dict
+        Plume parameters: mass (peak load in kg/m2), direction
+        (wind direction in rad), length (decay length in deg),
+        width (crosswind spread in deg) and shift (vent offset)
+
+    Returns
+    -------
+    load: numpy array
+        Deposit load in kg/m2
+    """
+    dlat = lat - vent[0] - params['shift'][0]
+    dlon = (lon - vent[1] - params['shift'][1]) * np.cos(np.deg2rad(vent[0]))
+    s =  dlat*np.cos(params['direction']) + dlon*np.sin(params['direction'])
+    c = -dlat*np.sin(params['direction']) + dlon*np.cos(params['direction'])
+    w = params['width']*(1+0.5*np.abs(s))
+    load  = params['mass'] * np.exp(-np.abs(s)/params['length'] - 0.5*(c/w)**2)
+    load *= np.where(s<0,np.exp(4*s/params['length']),1.0)
+    return load
+
+def get_params(rng):
+    """
+    Draw random plume parameters for an ensemble member
+    """
+    return {'mass':      rng.lognormal(np.log(100),0.3),
+            'direction': rng.normal(np.deg2rad(60),np.deg2rad(10)),
+            'length':    rng.lognormal(np.log(1.5),0.2),
+            'width':     rng.lognormal(np.log(0.3),0.2),
+            'shift':     rng.normal(0,0.1,2)}
+
+def make_ensemble(fname,nens,nlat,nlon,seed,dtype=np.float32):
+    """
+    Write a synthetic ensemble with a tephra_grn_load
+    variable and dimensions (time,ens,lat,lon)
+    """
+    rng  = np.random.default_rng([seed,nens,nlat,nlon])
+    lat  = np.linspace(*lat_range,nlat)
+    lon  = np.linspace(*lon_range,nlon)
+    lat2d, lon2d = np.meshgrid(lat,lon,indexing='ij')
+    data = np.zeros((2,nens,nlat,nlon),dtype=dtype)
+    for iens in range(nens):
+        data[1,iens] = get_plume(lat2d,lon2d,get_params(rng)) + 1E-3
+    ds = xr.Dataset({'tephra_grn_load': (('time','ens','lat','lon'),data,{'units': 'kg/m2'})},
+                    coords = {'time': [0.0,24.0],
+                              'ens':  np.arange(1,nens+1),
+                              'lat':  lat,
+                              'lon':  lon})
+    ds.to_netcdf(fname)
+
+def make_observations(path,nobs,seed):
+    """
+    Write deposit_XXX.csv files with nobs synthetic
+    measurements of a random plume and nested
+    assimilation datasets
+    """
+    rng = np.random.default_rng([seed,nobs])
+    params = get_params(rng)
+    ### Sites are mostly found inside the deposit
+    lat = rng.uniform(vent[0]-2,lat_range[1],10*nobs)
+    lon = rng.uniform(vent[1],lon_range[1],10*nobs)
+    thickness = 100/bulk_density * get_plume(lat,lon,params)
+    accept = rng.random(10*nobs) < np.where(thickness>thickness_min,1.0,0.05)
+    lat       = lat[accept][:nobs]
+    lon       = lon[accept][:nobs]
+    thickness = thickness[accept][:nobs]
+    nobs      = len(thickness)
+    #
+    thickness *= rng.lognormal(0,relative_error,nobs)
+    thickness[thickness<0.5*thickness_min] = 0
+    df = pd.DataFrame({'latitude':  lat,
+                       'longitude': lon,
+                       'thickness': thickness,
+                       'error':     np.maximum(relative_error*thickness,relative_error*thickness_min),
+                       'error_r':   relative_error,
+                       'cluster':   rng.integers(0,n_clusters,nobs),
+                       })
+    order = rng.permutation(nobs)
+    makedirs(path,exist_ok=True)
+    for percentAss in np.arange(5,105,5):
+        nobsAss = nobs if percentAss==100 else int(percentAss*0.01*nobs)
+        df['dataset'] = 'validation'
+        df.loc[order[:nobsAss],'dataset'] = 'assimilation'
+        df.to_csv(join(path,"deposit_{:03d}.csv".format(percentAss)),index=False)
+
+###
+### Equivalence checks
+###
+def check_incremental(fname_ens,path_obs):
+    """
+    Check that the incremental ENKF and GIG modes give the
+    same analyses as full assimilations of the nested
+    observation subsets
+
+    Returns
+    -------
+    errors: dict
+        Maximum relative difference for each method
+    """
+    errors = {}
+    #
+    inc = ENKF('ensemble',incremental=True)
+    ref = ENKF('ensemble')
+    inc.read_ensemble(fname_ens,bulk_density)
+    ref.share_ensemble(inc)
+    error = 0
+    for percentAss in np.arange(10,105,5):
+        fname_obs = join(path_obs,"deposit_{:03d}.csv".format(percentAss))
+        for data in [inc,ref]:
+            data.read_observations(fname_obs)
+            data.apply_ObsOp()
+            data.assimilate()
+        error = max(error,float(abs(inc.xam-ref.xam).max()/abs(ref.xam).max()))
+    errors['ENKF'] = error
+    #
+    inc = GIG(thickness_min,nsample=2,seed=seed,incremental=True)
+    ref = GIG(thickness_min,nsample=2,seed=seed)
+    inc.read_ensemble(fname_ens,bulk_density)
+    ref.share_ensemble(inc)
+    error = 0
+    for percentAss in np.arange(10,105,5):
+        fname_obs = join(path_obs,"deposit_{:03d}.csv".format(percentAss))
+        inc.read_observations(fname_obs,random_sort=True)
+        inc.apply_ObsOp()
+        inc.assimilate()
+        #Full assimilation using the order of the incremental run
+        ref.read_observations(fname_obs)
+        ref.df   = inc.df
+        ref.apply_ObsOp()
+        ref.assimilate()
+        error = max(error,float(abs(inc.xam-ref.xam).max()/abs(ref.xam).max()))
+    errors['GIG'] = error
+    return errors
+
+def check_precision(fname_ens,path_obs):
+    """
+    Check that analyses computed with float32 ensemble
+    states are close to the float64 analyses. A float64
+    ensemble file must be used, otherwise both runs read
+    the same float32 values
+
+    Returns
+    -------
+    errors: dict
+        Maximum relative difference for each method
+    """
+    fname_obs = join(path_obs,"deposit_100.csv")
+    errors = {}
+    for method in methods:
+        xam = []
+        for dtype in ['float64','float32']:
+            np.random.seed(seed)
+            data = get_method(method)
+            data.read_ensemble(fname_ens,bulk_density,dtype=dtype)
+            data.read_observations(fname_obs,random_sort[method])
+            data.apply_ObsOp(path_cache)
+            data.assimilate()
+            xam.append(data.xam)
+        errors[method] = float(abs(xam[1]-xam[0]).max()/abs(xam[0]).max())
+    return errors
+
+def check_solvers(fname_ens,path_obs):
+    """
+    Check that the squarem and multiplicative GNC solvers
+    give the same weights when both stop on the KKT residual.
+    Subsets with a singular quadratic form are skipped, since
+    the minimum is not unique
+
+    Returns
+    -------
+    error: float
+        Maximum relative difference of the weights
+    """
+    max_iterations = 10*config.getint('GNC','max_iterations')
+    ref = GNC(max_iterations,kkt_tolerance=kkt_tolerance)
+    ref.read_ensemble(fname_ens,bulk_density)
+    Q,b = [],[]
+    for percentAss in np.arange(10,105,5):
+        ref.read_observations(join(path_obs,"deposit_{:03d}.csv".format(percentAss)))
+        ref.apply_ObsOp()
+        items = ref.get_system()
+        Q.append(items[0])
+        b.append(items[1])
+    Q,b  = np.stack(Q),np.stack(b)
+    full = np.linalg.matrix_rank(Q) == ref.nens
+    w    = {}
+    for solver in GNC.solvers:
+        data = GNC(max_iterations,solver=solver,kkt_tolerance=kkt_tolerance)
+        data.share_ensemble(ref)
+        w[solver],_ = data.solve_batch(Q[full],b[full])
+    error = np.abs(w['squarem']-w['multiplicative']).max(axis=1)/w['multiplicative'].max(axis=1)
+    return float(error.max())
+
+def get_version():
+    """
+    Label for the code version: command line
+    argument or current git commit
+    """
+    if len(sys.argv)>1: return sys.argv[1]
+    try:
+        return subprocess.run(['git','rev-parse','--short','HEAD'],
+                              capture_output=True,text=True,check=True).stdout.strip()
+    except (OSError,subprocess.CalledProcessError):
+        return 'unknown'
+
+if __name__ == '__main__':
+    version = get_version()
+
+    ###
+    ### Information screen
+    ###
+    if debug:
+        print("""
+        --------------------------------------------
+        Benchmark of assimilation methods
+        --------------------------------------------
+        Input parameters:
+        methods = {methods}
+        ensemble sizes = {nens}
+        number of observations = {nobs}
+        grid sizes = {grid}
+        version = {version}
+        """.format(methods = " ".join(methods),
+                   nens    = list_nens,
+                   nobs    = list_nobs,
+                   grid    = ["{}x{}".format(*item) for item in list_grid],
+                   version = version)
+              )
+
+    ###
+    ### Run benchmark cases
+    ###
+    makedirs(path,exist_ok=True)
+    fname_an = join(path,"analysis.nc")
+    if checks:
+        nlat,nlon = list_grid[0]
+        nens      = list_nens[0]
+        nobs      = list_nobs[0]
+        fname_ens = join(path,"ensemble_{}_{}x{}.nc".format(nens,nlat,nlon))
+        path_obs  = join(path,"obs_{}".format(nobs))
+        if not isfile(fname_ens): make_ensemble(fname_ens,nens,nlat,nlon,seed)
+        if not isfile(join(path_obs,"deposit_100.csv")): make_observations(path_obs,nobs,seed)
+        if debug: print("Checking incremental assimilation")
+        for method,error in check_incremental(fname_ens,path_obs).items():
+            if debug: print("  {}: maximum relative difference = {:.2e}".format(method,error))
+            if error > 1E-8:
+                raise ValueError("Incremental {} analysis differs from full assimilation".format(method))
+        if debug: print("Checking float32 precision")
+        fname_ens = join(path,"ensemble_{}_{}x{}_float64.nc".format(nens,nlat,nlon))
+        if not isfile(fname_ens): make_ensemble(fname_ens,nens,nlat,nlon,seed,dtype=np.float64)
+        for method,error in check_precision(fname_ens,path_obs).items():
+            if debug: print("  {}: maximum relative difference = {:.2e}".format(method,error))
+            if error > tolerances[method]:
+                raise ValueError("Float32 {} analysis differs from float64 analysis".format(method))
+        if debug: print("Checking GNC solvers")
+        error = check_solvers(fname_ens,path_obs)
+        if debug: print("  squarem: maximum relative difference = {:.2e}".format(error))
+        if error > tolerances['GNC']:
+            raise ValueError("GNC squarem weights differ from multiplicative weights")
+
+    data = []
+    tracemalloc.start()
+    for nlat,nlon in list_grid:
+        for nens in list_nens:
+            fname_ens = join(path,"ensemble_{}_{}x{}.nc".format(nens,nlat,nlon))
+            if not isfile(fname_ens):
+                if debug: print("Creating synthetic ensemble: {}".format(fname_ens))
+                make_ensemble(fname_ens,nens,nlat,nlon,seed)
+            for nobs in list_nobs:
+                path_obs  = join(path,"obs_{}".format(nobs))
+                fname_obs = join(path_obs,"deposit_100.csv")
+                if not isfile(fname_obs):
+                    if debug: print("Creating synthetic observations: {}".format(path_obs))
+                    make_observations(path_obs,nobs,seed)
+                for method in methods:
+                    np.random.seed(seed)
+                    method_data = get_method(method)
+                    stages = [('read_ensemble',     lambda: method_data.read_ensemble(fname_ens,bulk_density,
+                                                                                  lazy       = lazy_loading,
+                                                                                  max_memory = max_memory,
+                                                                                  dtype      = precision)),
+                              ('read_observations', lambda: method_data.read_observations(fname_obs,random_sort[method])),
+                              ('apply_ObsOp',       lambda: method_data.apply_ObsOp(path_cache)),
+                              ('assimilate',        method_data.assimilate),
+                              ('to_netcdf',         lambda: method_data.to_netcdf(fname_an)),
+                              ]
+                    for stage,func in stages:
+                        tracemalloc.reset_peak()
+                        memory = tracemalloc.get_traced_memory()[0]
+                        t = perf_counter()
+                        func()
+                        time = perf_counter()-t
+                        peak = tracemalloc.get_traced_memory()[1]-memory
+                        data.append({'version':    version,
+                                     'method':     method,
+                                     'nens':       nens,
+                                     'nobs':       method_data.nobs if stage!='read_ensemble' else nobs,
+                                     'nlat':       nlat,
+                                     'nlon':       nlon,
+                                     'precision':  precision,
+                                     'stage':      stage,
+                                     'time':       time,
+                                     'peak_memory':peak/2**20,
+                                     })
+                    del method_data
+                    if debug: print("Finished {} nens={} nobs={} grid={}x{}".format(method,nens,nobs,nlat,nlon))
+    tracemalloc.stop()
+
+    ###
+    ### Save results
+    ###
+    df = pd.DataFrame(data)
+    if debug:
+        print(df.pivot_table(index=['method','nens','nobs','nlat','nlon'],
+                             columns='stage',values='time',sort=False))
+    fname = join(path,fname_results)
+    if isfile(fname):
+        df = pd.concat([pd.read_csv(fname),df],ignore_index=True)
+    if debug: print("Saving benchmark results: {}".format(fname))
+    df.to_csv(fname,index=False)
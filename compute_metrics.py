@@ -1,8 +1,11 @@
 import pandas as pd
 import numpy as np
-import xarray as xr
-from os.path import join
+import hashlib
+from os import makedirs, stat
+from os.path import join, isfile, abspath
 import sys
+from obsop import get_ObsOp
+from store import open_analysis, get_source, get_obs_source, read_observations
 from configparser import ConfigParser
 
 ###
@@ -15,85 +18,143 @@ config.read('config.ini')
 #### Parameters
 ####
 path_obs        = config.get('DATA','path')
+fname_obsstore  = config.get('DATA','fname_obsstore')
+path_cache      = config.get('DEFAULT','path_cache')
+fname_store     = config.get('DEFAULT','fname_store')
+fname_csv       = "validation_metrics.csv"
+fname_all       = "validation_metrics_all.csv"
+datasets        = ["assimilation","validation"]
+fields          = ["forecast","analysis"]
 debug           = True
 
-###
-### Information screen
-###
-if debug:
-    print("""
-    --------------------------
-    Compute validation metrics
-    --------------------------
-    """)
+def get_values(path,percentAss,df):
+    """
+    Interpolate forecast and analysis fields to the observation
+    sites. Interpolated values are cached on disk using the file
+    name, size and modification time of the analysis file, the
+    weights file or the consolidated store
+
+    Parameters
+    ----------
+    path: str
+        Output folder of the run
+    percentAss: int
+        Percentage of assimilated observations
+    df: pandas DataFrame
+        Observation sites
+
+    Returns
+    -------
+    values: dict
+        Interpolated values for each field
+    """
+    fname_an = get_source(path,percentAss,fname_store)
+    info     = stat(fname_an)
+    key      = hashlib.sha1("{}|{}|{}|{}|{}".format(abspath(fname_an),info.st_size,info.st_mtime_ns,
+                                                    path,percentAss).encode())
+    key.update(np.ascontiguousarray(df[['latitude','longitude']].to_numpy(dtype=float)).tobytes())
+    fname = join(path_cache,"values_{}.npz".format(key.hexdigest()))
+    if isfile(fname):
+        with np.load(fname) as data:
+            return {field: data[field] for field in fields}
+    with open_analysis(path,percentAss,fname_store) as ds:
+        H = get_ObsOp(ds.lat,ds.lon,df['latitude'],df['longitude'],path=path_cache)
+        values = {field: H.apply(ds[field]).values for field in fields}
+    makedirs(path_cache,exist_ok=True)
+    np.savez(fname,**values)
+    return values
+
+def get_metrics(df):
+    """
+    Compute validation metrics for every group of a long-format
+    table in a single groupby reduction
 
-try:
-    path = sys.argv[1]
-except:
-    path = './'
+    Parameters
+    ----------
+    df: pandas DataFrame
+        Table with columns path, percentAss, dataset, field,
+        yo (observation), ye (error) and ym (model value)
 
-data = []
-for percentAss in np.arange(10,105,5):
+    Returns
+    -------
+    metrics: pandas DataFrame
+        Metrics rmse, bias, mae, smape (%) and hits (%) for each
+        (path,percentAss,dataset,field) combination
+    """
+    e  = (df.yo-df.ym)/df.ye
+    e1 = (df.yo-df.ym).abs()
+    e2 = df.yo.abs()+df.ym.abs()
+    terms = pd.DataFrame({'bias':  e,
+                          'mae':   e.abs(),
+                          'mse':   e**2,
+                          'smape': (e1/e2).where(e2>0),
+                          'hits':  ((df.ym<3*df.yo) & (3*df.ym>df.yo)).astype(float),
+                          })
+    keys = [df.path,df.percentAss,
+            pd.Categorical(df.dataset,categories=datasets),
+            pd.Categorical(df.field,categories=fields)]
+    metrics = terms.groupby(keys,observed=True).mean()
+    metrics.index.names = ['path','percentAss','dataset','field']
+    metrics['rmse']  = np.sqrt(metrics.pop('mse'))
+    metrics['smape'] = 100*metrics['smape']
+    metrics['hits']  = 100*metrics['hits']
+    return metrics[['rmse','bias','mae','smape','hits']].reset_index()
+
+if __name__ == '__main__':
     ###
-    ### Read model data
+    ### Information screen
     ###
-    fname_an = "analysis_{:03d}.nc".format(percentAss)
-    fname_an = join(path,fname_an) 
-    if debug: print("Opening analysis file: {}".format(fname_an))
-    ds = xr.open_dataset(fname_an)
-    ####
-    #### Read obs data
-    ####
-    fname_obs = "deposit_{:03d}.csv".format(percentAss)
-    fname_obs = join(path_obs,fname_obs)
-    if debug: print("Opening observation file: {}".format(fname_obs))
-    df = pd.read_csv(fname_obs)
-    nobs = len(df)
-    if debug: print("Number of observations: {}".format(nobs))
+    if debug:
+        print("""
+        --------------------------
+        Compute validation metrics
+        --------------------------
+        """)
+
+    paths = sys.argv[1:] or ['./']
+
     ###
-    ### Interpolation to observation sites
+    ### Build a long-format table of observations
+    ### and interpolated model values
     ###
-    if debug: print("Performing interpolations")
-    lat_obs = xr.DataArray(df['latitude'], dims='loc')
-    lon_obs = xr.DataArray(df['longitude'],dims='loc')
-    y       = ds.interp(lat=lat_obs,lon=lon_obs)
-    df['forecast'] = y.forecast
-    df['analysis'] = y.analysis
+    frames = []
+    for percentAss in np.arange(10,105,5):
+        ####
+        #### Read obs data
+        ####
+        fname_obs = get_obs_source(path_obs,percentAss,fname_obsstore)
+        if debug: print("Opening observations: {} {:03d}".format(fname_obs,percentAss))
+        df = read_observations(fname_obs,percentAss)
+        if debug: print("Number of observations: {}".format(len(df)))
+        for path in paths:
+            ###
+            ### Interpolation to observation sites
+            ###
+            if debug: print("Reading analysis: {} {:03d}".format(path,percentAss))
+            values = get_values(path,percentAss,df)
+            for field in fields:
+                frames.append(pd.DataFrame({'path':       path,
+                                            'percentAss': percentAss,
+                                            'dataset':    df['dataset'],
+                                            'field':      field,
+                                            'yo':         df['thickness'],
+                                            'ye':         df['error'],
+                                            'ym':         values[field],
+                                            }))
+    df = pd.concat(frames,ignore_index=True)
+
     ###
     ### Compute accuracy metrics
     ###
-    for dataset in ["assimilation","validation"]:
-        if percentAss==100 and dataset=='validation': continue
-        yo = df[df.dataset==dataset]['thickness']
-        ye = df[df.dataset==dataset]['error']
-        for field in ["forecast","analysis"]:
-            ym = df[df.dataset==dataset][field]
-            #
-            e     = (yo-ym)/ye
-            bias  = e.mean()
-            mae   = e.abs().mean()
-            mse   = (e**2).mean()
-            #
-            e1    = (yo-ym).abs()
-            e2    = yo.abs()+ym.abs()
-            smape = (e1[e2>0]/e2[e2>0]).mean()
-            #
-            hits  = ((ym<3*yo) & (3*ym>yo)).sum()/len(ym)
-            #
-            data.append({
-                'percentAss': percentAss,
-                'dataset':    dataset,
-                'field':      field,
-                'rmse':       np.sqrt(mse),
-                'bias':       bias,
-                'mae':        mae,
-                'smape':      100*smape,
-                'hits':       100*hits,
-                })
+    if debug: print("Computing metrics for {} values".format(len(df)))
+    df_out = get_metrics(df)
 
-fname_csv = "validation_metrics.csv"
-fname_csv = join(path,fname_csv)
-if debug: print("Saving output file: {}".format(fname_csv))
-df_out = pd.DataFrame(data)
-df_out.set_index("percentAss",inplace=True)
-df_out.to_csv(fname_csv)
+    for path,df_path in df_out.groupby('path',sort=False):
+        fname = join(path,fname_csv)
+        if debug: print("Saving output file: {}".format(fname))
+        df_path = df_path.drop(columns='path')
+        df_path.set_index("percentAss",inplace=True)
+        df_path.to_csv(fname)
+    if len(paths)>1:
+        if debug: print("Saving output file: {}".format(fname_all))
+        df_out.to_csv(fname_all,index=False)
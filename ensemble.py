@@ -0,0 +1,110 @@
+import numpy as np
+
+class EnsembleStats:
+    """
+    Single-pass statistics of an ensemble read by chunks
+    of members. The mean and variance are updated using
+    the Welford algorithm and weighted sums over members
+    are accumulated with a matrix-vector product for each
+    chunk. A single extra buffer of the state size is used
+
+    Covariances with vectors in the observation space
+    (e.g. cov(x,yf) for an ensemble yf) are weighted sums
+    using the anomalies of these vectors as weights
+
+    Attributes
+    ----------
+    count: int
+        Number of members processed
+    mean: numpy array
+        Ensemble mean with shape (nstate,)
+    sums: numpy array
+        Weighted sums with shape (nweights,nstate)
+
+    Methods
+    -------
+    update(x)
+        Add a chunk of members
+    get_variance(ddof=1)
+        Ensemble variance
+    """
+
+    def __init__(self,nstate,weights=None,variance=False,dtype=np.float64):
+        """
+        Parameters
+        ----------
+        nstate: int
+            State size
+        weights: numpy array, optional
+            Weights of each member with shape (nens,nweights)
+        variance: bool, optional
+            If the ensemble variance should be computed
+        dtype: str or numpy dtype, optional
+            Data type of accumulators
+        """
+        self.count   = 0
+        self.mean    = np.zeros(nstate,dtype=dtype)
+        self.m2      = np.zeros(nstate,dtype=dtype) if variance else None
+        self.weights = None if weights is None else np.asarray(weights,dtype=dtype)
+        if self.weights is None:
+            self.sums = np.zeros((0,nstate),dtype=dtype)
+        else:
+            self.sums = np.zeros((self.weights.shape[1],nstate),dtype=dtype)
+        self._buffer = np.empty(nstate,dtype=dtype)
+
+    def update(self,x):
+        """
+        Add a chunk of members
+
+        Parameters
+        ----------
+        x: numpy array
+            Next members of the ensemble with shape (m,nstate)
+        """
+        buffer = self._buffer
+        chunk  = slice(self.count,self.count+len(x))
+        if self.weights is not None:
+            for weights,sums in zip(self.weights[chunk].T,self.sums):
+                np.dot(weights,x,out=buffer)
+                sums += buffer
+        for xi in x:
+            self.count += 1
+            k = self.count
+            # delta/k with delta = x - mean
+            np.subtract(xi,self.mean,out=buffer)
+            buffer /= k
+            self.mean += buffer
+            if self.m2 is not None:
+                # m2 += delta*(x-mean) = k*(k-1)*(delta/k)**2
+                np.square(buffer,out=buffer)
+                buffer *= k*(k-1)
+                self.m2 += buffer
+
+    def get_variance(self,ddof=1):
+        """
+        Ensemble variance with shape (nstate,)
+        """
+        if self.m2 is None:
+            raise TypeError("Variance not computed")
+        return self.m2/(self.count-ddof)
+
+def get_anomalies(y):
+    """
+    Ensemble mean and anomalies in the observation space.
+    The anomalies overwrite the input array
+
+    Parameters
+    ----------
+    y: numpy array
+        Ensemble with shape (nens,nobs)
+
+    Returns
+    -------
+    ym: numpy array
+        Ensemble mean with shape (nobs,)
+    yp: numpy array
+        Anomalies y-ym (same array as y)
+    """
+    ym = y.mean(axis=0)
+    y -= ym
+    return ym, y
@@ -0,0 +1,148 @@
+import pandas as pd
+import xarray as xr
+from os import stat
+from os.path import abspath
+from obsop import get_ObsOp
+from store import open_analysis as _open_analysis, get_source, read_weights, reconstruct as _reconstruct
+from store import get_obs_source, read_observations as _read_observations
+
+###
+### Inputs of the figure scripts loaded once and kept
+### in memory. Entries are identified by the arguments
+### and the size and modification time of input files
+###
+_data  = {}
+inputs = {}      # Input files read: signature
+calls  = []      # Calls used to load inputs (for preloading)
+
+def get_signature(fname):
+    """
+    Size and modification time of a file
+    """
+    info = stat(fname)
+    return [info.st_size, info.st_mtime_ns]
+
+def reset():
+    """
+    Clear the record of inputs and calls
+    (cached data are kept)
+    """
+    inputs.clear()
+    calls.clear()
+
+def preload(items):
+    """
+    Load inputs using a list of recorded calls. Calls
+    with missing inputs (files removed or entries not in
+    a store) are skipped: the figure script reports the
+    error when it is rendered. Other errors are raised
+
+    Parameters
+    ----------
+    items: list
+        Pairs [name,args] of functions in this module
+    """
+    for name,args in items:
+        try:
+            globals()[name](*args)
+        except (FileNotFoundError,KeyError):
+            pass
+
+def _get(name,args,files,loader):
+    """
+    Return a cached entry or load it
+    """
+    files = [abspath(fname) for fname in files]
+    signatures = [get_signature(fname) for fname in files]
+    for fname,signature in zip(files,signatures):
+        inputs[fname] = signature
+    if not [name,list(args)] in calls:
+        calls.append([name,list(args)])
+    key = (name,tuple(args),tuple(tuple(item) for item in signatures))
+    if not key in _data:
+        _data[key] = loader()
+    return _data[key]
+
+def read_csv(fname):
+    """
+    Read a CSV file. A copy of the cached
+    DataFrame is returned
+    """
+    return _get('read_csv',[fname],[fname],
+                lambda: pd.read_csv(fname)).copy()
+
+def read_observations(fname,percentAss):
+    """
+    Read the observation table of a split (see
+    store.read_observations). A copy of the cached
+    DataFrame is returned
+    """
+    return _get('read_observations',[fname,percentAss],[fname],
+                lambda: _read_observations(fname,percentAss)).copy()
+
+def open_dataset(fname):
+    """
+    Read a NetCDF file into memory
+    """
+    def loader():
+        with xr.open_dataset(fname) as ds:
+            return ds.load()
+    return _get('open_dataset',[fname],[fname],loader).copy()
+
+def open_analysis(path,percentAss,fname_store=None):
+    """
+    Read the forecast and analysis of a run into
+    memory (see store.open_analysis)
+    """
+    def loader():
+        with _open_analysis(path,percentAss,fname_store) as ds:
+            return ds.load()
+    fname = get_source(path,percentAss,fname_store)
+    return _get('open_analysis',[path,percentAss,fname_store],[fname],loader).copy()
+
+def open_ensemble(fname_ens,bulk_density):
+    """
+    Read the deposit thickness in cm of the prior
+    ensemble (last time slice)
+    """
+    def loader():
+        with xr.open_dataset(fname_ens) as ds:
+            #Convert mass loading (kg/m2) to thickness (cm)
+            #using deposit bulk density (kg/m3)
+            return 100.0/bulk_density * ds.isel(time=-1)['tephra_grn_load'].load()
+    return _get('open_ensemble',[fname_ens,bulk_density],[fname_ens],loader)
+
+def get_values(path,percentAss,fname_obs,fname_store=None,path_cache=None):
+    """
+    Forecast and analysis of a run interpolated to the
+    sites of an observation file or store
+
+    Returns
+    -------
+    values: dict
+        Interpolated values for each field
+    """
+    def loader():
+        ds = open_analysis(path,percentAss,fname_store)
+        df = read_observations(fname_obs,percentAss)
+        H  = get_ObsOp(ds.lat,ds.lon,df['latitude'],df['longitude'],path=path_cache)
+        return {field: H.apply(ds[field]).values for field in ['forecast','analysis']}
+    fname = get_source(path,percentAss,fname_store)
+    return _get('get_values',[path,percentAss,fname_obs,fname_store,path_cache],
+                [fname,fname_obs],loader)
+
+def reconstruct(fname_w,fname,variable):
+    """
+    Weighted sum of a variable over the ensemble members
+    using a weights file (see store.reconstruct)
+    """
+    return _get('reconstruct',[fname_w,fname,variable],[fname_w,fname],
+                lambda: _reconstruct(read_weights(fname_w),fname,variable))
+
+def load_basemap(fname):
+    """
+    Read the basemap cache (see basemap.load_basemap)
+    """
+    from basemap import load_basemap as _load_basemap
+    return _get('load_basemap',[fname],[fname],
+                lambda: _load_basemap(fname))
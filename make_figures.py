@@ -0,0 +1,173 @@
+import json
+import hashlib
+import runpy
+import sys
+import multiprocessing
+import figdata
+from time import perf_counter
+from os.path import isfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from configparser import ConfigParser
+
+###
+### Read configuration file
+###
+config = ConfigParser(inline_comment_prefixes="#")
+config.read('config.ini')
+
+###
+### Parameters
+###
+block           = 'FIGURES'
+scripts         = config.get(block,'scripts').split()
+max_workers     = config.getint(block,'max_workers')
+fname_manifest  = config.get(block,'fname_manifest')
+debug           = True
+
+def get_hash(fname):
+    """
+    SHA1 hash of the contents of a file
+    """
+    with open(fname,'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def is_updated(entry):
+    """
+    Check if a figure is up to date: the output file exists
+    and the script, the configuration file and the inputs
+    have not changed since the last render
+
+    Parameters
+    ----------
+    entry: dict
+        Manifest entry of the figure
+    """
+    if entry is None: return False
+    if not all(isfile(fname) for fname in entry['outputs']): return False
+    if entry['script'] != get_hash(entry['name']): return False
+    if entry['config'] != get_hash('config.ini'): return False
+    for fname,signature in entry['inputs'].items():
+        if not isfile(fname) or figdata.get_signature(fname) != signature: return False
+    return True
+
+def load(script):
+    """
+    Run a figure script without drawing it: figures are
+    not saved, so only the inputs are loaded (and kept in
+    the cache of this process). Used before forking the
+    workers when the inputs of a figure are not recorded
+    """
+    from matplotlib.figure import Figure
+    savefig = Figure.savefig
+    Figure.savefig = lambda *args, **kwargs: None
+    try:
+        runpy.run_path(script,run_name='__main__')
+    finally:
+        Figure.savefig = savefig
+        plt = sys.modules.get('matplotlib.pyplot')
+        if plt is not None: plt.close('all')
+
+def render(script):
+    """
+    Run a figure script in a worker process. Data loaded
+    by the parent process are shared (fork start method)
+
+    Returns
+    -------
+    entry: dict
+        Manifest entry with the inputs, the calls used
+        to load them and the output files
+    """
+    figdata.reset()
+    t = perf_counter()
+    variables = runpy.run_path(script,run_name='__main__')
+    plt = sys.modules.get('matplotlib.pyplot')
+    if plt is not None: plt.close('all')
+    outputs = [variables[key] for key in ['fname_out','fname_plt'] if key in variables]
+    return {'name':    script,
+            'script':  get_hash(script),
+            'config':  get_hash('config.ini'),
+            'inputs':  dict(figdata.inputs),
+            'calls':   list(figdata.calls),
+            'outputs': outputs,
+            'time':    perf_counter()-t}
+
+if __name__ == '__main__':
+    ###
+    ### Information screen
+    ###
+    if debug:
+        print("""
+        ---------------------------
+        Render the paper figures
+        ---------------------------
+        Input parameters:
+        scripts = {scripts}
+        number of workers = {max_workers}
+        """.format(scripts     = " ".join(scripts),
+                   max_workers = max_workers)
+              )
+
+    ###
+    ### Figures with changed inputs. Scripts given
+    ### in the command line are always rendered
+    ###
+    manifest = {}
+    if isfile(fname_manifest):
+        with open(fname_manifest) as f:
+            manifest = json.load(f)
+    forced = sys.argv[1:]
+    tasks  = [script for script in forced+scripts
+              if script in forced or not is_updated(manifest.get(script))]
+    tasks  = list(dict.fromkeys(tasks))
+    for script in scripts:
+        if not script in tasks and debug: print("Skipping {}: up to date".format(script))
+
+    ###
+    ### Load the inputs of the previous render
+    ### once before forking the workers
+    ###
+    calls = [item for script in tasks if script in manifest
+                  for item in manifest[script]['calls']]
+    if calls:
+        if debug: print("Loading {} shared inputs".format(len(calls)))
+        figdata.preload(calls)
+
+    ###
+    ### Figures without recorded inputs (e.g. first
+    ### build) are run here without drawing, so their
+    ### inputs are loaded once and shared by the workers
+    ###
+    t0 = perf_counter()
+    for script in [script for script in tasks if not script in manifest]:
+        t = perf_counter()
+        try:
+            load(script)
+        except Exception as e:
+            print("**WARNING** {} failed: {}".format(script,e))
+            tasks.remove(script)
+            continue
+        if debug: print("Loaded inputs of {}: {:.2f} s".format(script,perf_counter()-t))
+
+    ###
+    ### Render figures
+    ###
+    if tasks:
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = {executor.submit(render,script): script for script in tasks}
+            for future in as_completed(futures):
+                script = futures[future]
+                try:
+                    entry = future.result()
+                except Exception as e:
+                    print("**WARNING** {} failed: {}".format(script,e))
+                    manifest.pop(script,None)
+                    continue
+                if debug: print("Rendered {}: {:.2f} s".format(script,entry.pop('time')))
+                manifest[script] = entry
+    if debug: print("Elapsed time: {:.2f} s".format(perf_counter()-t0))
+
+    if debug: print("Saving manifest: {}".format(fname_manifest))
+    with open(fname_manifest,'w') as f:
+        json.dump(manifest,f,indent=1)
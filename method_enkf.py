@@ -1,5 +1,6 @@
 import numpy as np
 from assimilation import ENKF as AssimilationMethod
+from store import get_obs_source
 from os.path import join
 from configparser import ConfigParser
 
@@ -14,9 +15,24 @@ config.read('config.ini')
 ###
 block           = 'ENKF'
 path_obs        = config.get('DATA','path')
+fname_obsstore  = config.get('DATA','fname_obsstore')
 path            = config.get(block,'path')
 fname_ens       = config.get(block,'fname_ens')
 bulk_density    = config.getfloat(block,'bulk_density')
+solver          = config.get(block,'solver')
+localization    = config.getfloat(block,'localization')
+taper           = config.get(block,'taper')
+tile_size       = config.getint(block,'tile_size')
+max_workers     = config.getint(block,'max_workers')
+incremental     = config.getboolean(block,'incremental')
+lazy_loading    = config.getboolean(block,'lazy_loading')
+max_memory      = config.getfloat(block,'max_memory')
+precision       = config.get(block,'precision')
+path_cache      = config.get(block,'path_cache')
+profiling       = config.getboolean(block,'profiling')
+trace_memory    = config.getboolean(block,'trace_memory')
+fname_profile   = config.get(block,'fname_profile')
+fname_store     = config.get(block,'fname_store')
 debug           = True
 
 ###
@@ -29,35 +45,52 @@ if debug:
     -----------------------------------------
     Input parameters:
     bulk density = {bulk_density} kg/m3
-    """.format(bulk_density = bulk_density)
+    precision = {precision}
+    solver = {solver}
+    localization radius = {localization} km
+    incremental: {incremental}
+    """.format(bulk_density = bulk_density,
+               precision    = precision,
+               solver       = solver,
+               localization = localization,
+               incremental  = incremental)
           )
 
 ###
 ### Use the EnKF method
 ###
-data = AssimilationMethod()
+data = AssimilationMethod(solver,
+                          radius      = localization,
+                          taper       = taper,
+                          tile_size   = tile_size,
+                          max_workers = max_workers,
+                          incremental = incremental)
+
+if profiling: data.profiler.enable(trace_memory)
 
 ###
 ### Read model data
 ###
 if debug: print("Opening simulation output file: {}".format(fname_ens))
-data.read_ensemble(fname_ens,bulk_density)
+data.read_ensemble(fname_ens,bulk_density,
+                   lazy       = lazy_loading,
+                   max_memory = max_memory,
+                   dtype      = precision)
 
 for percentAss in np.arange(10,105,5):
     ####
     #### Read obs data
     ####
-    fname_obs = "deposit_{:03d}.csv".format(percentAss)
-    fname_obs = join(path_obs,fname_obs)
-    if debug: print("Opening observation file: {}".format(fname_obs))
-    data.read_observations(fname_obs)
+    fname_obs = get_obs_source(path_obs,percentAss,fname_obsstore)
+    if debug: print("Opening observations: {} {:03d}".format(fname_obs,percentAss))
+    data.read_observations(fname_obs,percentAss=percentAss)
     if debug: print("Number of observations: {}".format(data.nobs))
 
     ###
     ### Interpolation to observation sites
     ###
     if debug: print("Performing interpolations")
-    data.apply_ObsOp()
+    data.apply_ObsOp(path_cache)
 
     ###
     ### Assimilate
@@ -68,7 +101,15 @@ for percentAss in np.arange(10,105,5):
     ###
     ### Save analysis data
     ###
-    fname_an = "analysis_{:03d}.nc".format(percentAss)
-    fname_an = join(path,fname_an)
-    if debug: print("Saving analysis output file: {}".format(fname_an))
-    data.to_netcdf(fname_an)
+    if fname_store:
+        if debug: print("Saving analysis to store: {}".format(fname_store))
+        data.to_netcdf(fname_store,percentAss=percentAss)
+    else:
+        fname_an = "analysis_{:03d}.nc".format(percentAss)
+        fname_an = join(path,fname_an)
+        if debug: print("Saving analysis output file: {}".format(fname_an))
+        data.to_netcdf(fname_an)
+    data.profiler.dump(fname_profile,
+                       method     = block,
+                       percentAss = percentAss,
+                       sample     = None)
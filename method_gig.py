@@ -1,5 +1,6 @@
 import numpy as np
 from assimilation import GIG as AssimilationMethod
+from store import get_obs_source
 from os.path import join
 from configparser import ConfigParser
 
@@ -14,11 +15,25 @@ config.read('config.ini')
 ###
 block           = 'GIG'
 path_obs        = config.get('DATA','path')
+fname_obsstore  = config.get('DATA','fname_obsstore')
 path            = config.get(block,'path')
 fname_ens       = config.get(block,'fname_ens')
 bulk_density    = config.getfloat(block,'bulk_density')
+lazy_loading    = config.getboolean(block,'lazy_loading')
+max_memory      = config.getfloat(block,'max_memory')
+precision       = config.get(block,'precision')
+path_cache      = config.get(block,'path_cache')
+profiling       = config.getboolean(block,'profiling')
+trace_memory    = config.getboolean(block,'trace_memory')
+fname_profile   = config.get(block,'fname_profile')
+fname_store     = config.get(block,'fname_store')
 thickness_min   = config.getfloat(block,'thickness_min')
 nsample         = config.getint(block,'nsample')
+multisample     = config.getboolean(block,'multisample')
+split_output    = config.getboolean(block,'split_output')
+incremental     = config.getboolean(block,'incremental')
+tile_size       = config.getint(block,'tile_size')
+max_workers     = config.getint(block,'max_workers')
 random_sort     = True
 debug           = True
 
@@ -32,53 +47,105 @@ if debug:
     ---------------------------------
     Input parameters:
     bulk density = {bulk_density} kg/m3
+    precision = {precision}
     minimum thickness = {thickness_min} cm
     number of realisations = {nsample}
+    single pass realisations: {multisample}
     using random sorting: {random_sort}
+    incremental: {incremental}
+    threads for the state update = {max_workers}
     """.format(bulk_density  = bulk_density,
+               precision     = precision,
                thickness_min = thickness_min,
                nsample       = nsample,
-               random_sort   = random_sort)
+               multisample   = multisample,
+               random_sort   = random_sort,
+               incremental   = incremental,
+               max_workers   = max_workers)
           )
 
 ###
 ### Use the GIG (sequential) method
 ###
-data = AssimilationMethod(thickness_min)
+if multisample:
+    data = AssimilationMethod(thickness_min,
+                              nsample     = nsample,
+                              incremental = incremental,
+                              tile_size   = tile_size,
+                              max_workers = max_workers)
+else:
+    data = AssimilationMethod(thickness_min,
+                              tile_size   = tile_size,
+                              max_workers = max_workers)
+
+if profiling: data.profiler.enable(trace_memory)
 
 ###
 ### Read model data
 ###
 if debug: print("Opening simulation output file: {}".format(fname_ens))
-data.read_ensemble(fname_ens,bulk_density)
+data.read_ensemble(fname_ens,bulk_density,
+                   lazy       = lazy_loading,
+                   max_memory = max_memory,
+                   dtype      = precision)
 
 for percentAss in np.arange(10,105,5):
     ####
     #### Read obs data
     ####
-    fname_obs = "deposit_{:03d}.csv".format(percentAss)
-    fname_obs = join(path_obs,fname_obs)
-    if debug: print("Opening observation file: {}".format(fname_obs))
-    data.read_observations(fname_obs,random_sort=random_sort)
+    fname_obs = get_obs_source(path_obs,percentAss,fname_obsstore)
+    if debug: print("Opening observations: {} {:03d}".format(fname_obs,percentAss))
+    data.read_observations(fname_obs,random_sort=random_sort,percentAss=percentAss)
     if debug: print("Number of observations: {}".format(data.nobs))
 
     ###
     ### Interpolation to observation sites
     ###
     if debug: print("Performing interpolations")
-    data.apply_ObsOp()
+    data.apply_ObsOp(path_cache)
 
-    for isample in range(nsample):
-    ###
-    ### Assimilate
-    ###
+    if multisample:
+        ###
+        ### Assimilate all the realisations at once
+        ###
         if debug: print("Assimilating data")
         data.assimilate()
 
-    ###
-    ### Save analysis data
-    ###
-        fname_an = "analysis_{:03d}.nc".format(percentAss)
-        fname_an = join(path,"{:03d}".format(1+isample),fname_an)
-        if debug: print("Saving analysis output file: {}".format(fname_an))
-        data.to_netcdf(fname_an)
+        ###
+        ### Save analysis data
+        ###
+        if fname_store:
+            if debug: print("Saving analysis to store: {}".format(fname_store))
+            data.to_netcdf(fname_store,percentAss=percentAss)
+        else:
+            fname_an = "analysis_{:03d}.nc".format(percentAss)
+            fname_an = join(path,fname_an)
+            if debug: print("Saving analysis output file: {}".format(fname_an))
+            data.to_netcdf(fname_an,split=split_output)
+        data.profiler.dump(fname_profile,
+                           method     = block,
+                           percentAss = percentAss,
+                           sample     = None)
+    else:
+        for isample in range(nsample):
+        ###
+        ### Assimilate
+        ###
+            if debug: print("Assimilating data")
+            data.assimilate()
+
+        ###
+        ### Save analysis data
+        ###
+            if fname_store:
+                if debug: print("Saving analysis to store: {}".format(fname_store))
+                data.to_netcdf(fname_store,percentAss=percentAss,sample=1+isample)
+            else:
+                fname_an = "analysis_{:03d}.nc".format(percentAss)
+                fname_an = join(path,"{:03d}".format(1+isample),fname_an)
+                if debug: print("Saving analysis output file: {}".format(fname_an))
+                data.to_netcdf(fname_an)
+            data.profiler.dump(fname_profile,
+                               method     = block,
+                               percentAss = percentAss,
+                               sample     = 1+isample)
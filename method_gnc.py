@@ -1,5 +1,6 @@
 import numpy as np
 from assimilation import GNC as AssimilationMethod
+from store import get_obs_source
 from os.path import join
 from configparser import ConfigParser
 
@@ -14,10 +15,25 @@ config.read('config.ini')
 ###
 block           = 'GNC'
 path_obs        = config.get('DATA','path')
+fname_obsstore  = config.get('DATA','fname_obsstore')
 path            = config.get(block,'path')
 fname_ens       = config.get(block,'fname_ens')
 bulk_density    = config.getfloat(block,'bulk_density')
+lazy_loading    = config.getboolean(block,'lazy_loading')
+max_memory      = config.getfloat(block,'max_memory')
+precision       = config.get(block,'precision')
+path_cache      = config.get(block,'path_cache')
+profiling       = config.getboolean(block,'profiling')
+trace_memory    = config.getboolean(block,'trace_memory')
+fname_profile   = config.get(block,'fname_profile')
+fname_store     = config.get(block,'fname_store')
 max_iterations  = config.getint(block,'max_iterations')
+solver          = config.get(block,'solver')
+tolerance       = config.getfloat(block,'tolerance')
+kkt_tolerance   = config.getfloat(block,'kkt_tolerance')
+check_inversion = config.getboolean(block,'check_pinv')
+batch           = config.getboolean(block,'batch')
+weights_only    = config.getboolean(block,'weights_only')
 debug           = True
 
 ###
@@ -30,48 +46,110 @@ if debug:
     ---------------------------------
     Input parameters:
     bulk density = {bulk_density} kg/m3
+    precision = {precision}
     maximum number of iterations = {max_iterations}
+    solver = {solver}
+    KKT tolerance = {kkt_tolerance}
+    batch mode: {batch}
+    save weights only: {weights_only}
     """.format(bulk_density = bulk_density,
-               max_iterations = max_iterations)
+               precision    = precision,
+               max_iterations = max_iterations,
+               solver = solver,
+               kkt_tolerance = kkt_tolerance,
+               batch = batch,
+               weights_only = weights_only)
           )
 
 ###
 ### Use the GNC method
 ###
-data = AssimilationMethod(max_iterations)
+data = AssimilationMethod(max_iterations,
+                          solver          = solver,
+                          tolerance       = tolerance,
+                          kkt_tolerance   = kkt_tolerance,
+                          check_inversion = check_inversion)
+
+if profiling: data.profiler.enable(trace_memory)
 
 ###
 ### Read model data
 ###
 if debug: print("Opening simulation output file: {}".format(fname_ens))
-data.read_ensemble(fname_ens,bulk_density)
+data.read_ensemble(fname_ens,bulk_density,
+                   lazy       = lazy_loading,
+                   max_memory = max_memory,
+                   dtype      = precision)
 
-for percentAss in np.arange(10,105,5):
-    ####
-    #### Read obs data
-    ####
-    fname_obs = "deposit_{:03d}.csv".format(percentAss)
-    fname_obs = join(path_obs,fname_obs)
-    if debug: print("Opening observation file: {}".format(fname_obs))
-    data.read_observations(fname_obs)
-    if debug: print("Number of observations: {}".format(data.nobs))
+list_percentAss = np.arange(10,105,5)
 
-    ###
-    ### Interpolation to observation sites
-    ###
+def read_data(percentAss):
+    """
+    Read an observation subset and apply the
+    observation operator
+    """
+    fname_obs = get_obs_source(path_obs,percentAss,fname_obsstore)
+    if debug: print("Opening observations: {} {:03d}".format(fname_obs,percentAss))
+    data.read_observations(fname_obs,percentAss=percentAss)
+    if debug: print("Number of observations: {}".format(data.nobs))
     if debug: print("Performing interpolations")
-    data.apply_ObsOp()
+    data.apply_ObsOp(path_cache)
+
+###
+### Batch mode: solve the GNC problems of all
+### the observation subsets together. Profiling
+### records of each subset are completed after
+### the batch solve, which has its own record
+###
+if batch:
+    systems = []
+    records = []
+    for percentAss in list_percentAss:
+        read_data(percentAss)
+        systems.append(data.get_system())
+        records.append(data.profiler.get_record())
+        data.profiler.reset()
+    Q,b = (np.stack(item) for item in zip(*systems))
+    if debug: print("Solving {} problems in batch mode".format(len(b)))
+    W,infos = data.solve_batch(Q,b)
+    data.profiler.dump(fname_profile,
+                       method     = block,
+                       percentAss = None,
+                       sample     = None,
+                       batch_size = len(b))
 
+for i,percentAss in enumerate(list_percentAss):
     ###
     ### Assimilate
     ###
-    if debug: print("Assimilating data")
-    data.assimilate()
+    if batch:
+        if debug: print("Computing analysis: {:03d}".format(percentAss))
+        data.set_weights(W[i],infos[i],update=not weights_only)
+    else:
+        read_data(percentAss)
+        if debug: print("Assimilating data")
+        data.assimilate(update=not weights_only)
 
     ###
-    ### Save analysis data
+    ### Save weight factors and analysis data
     ###
-    fname_an = "analysis_{:03d}.nc".format(percentAss)
-    fname_an = join(path,fname_an)
-    if debug: print("Saving analysis output file: {}".format(fname_an))
-    data.to_netcdf(fname_an)
+    fname_w = "weights_{:03d}.nc".format(percentAss)
+    fname_w = join(path,fname_w)
+    if debug: print("Saving weight factors file: {}".format(fname_w))
+    data.weights_to_netcdf(fname_w)
+    if weights_only:
+        if debug: print("Analysis not saved (weights only)")
+    elif fname_store:
+        if debug: print("Saving analysis to store: {}".format(fname_store))
+        data.to_netcdf(fname_store,percentAss=percentAss)
+    else:
+        fname_an = "analysis_{:03d}.nc".format(percentAss)
+        fname_an = join(path,fname_an)
+        if debug: print("Saving analysis output file: {}".format(fname_an))
+        data.to_netcdf(fname_an)
+    record = records[i] if batch else {}
+    data.profiler.dump(fname_profile,
+                       **record,
+                       method     = block,
+                       percentAss = percentAss,
+                       sample     = None)
@@ -0,0 +1,235 @@
+import numpy as np
+import xarray as xr
+import hashlib
+from os import makedirs
+from os.path import join, isfile
+from scipy import sparse
+
+_cache = {}
+
+class ObsOp:
+    """
+    Bilinear observation operator stored as a sparse
+    interpolation matrix with 4 weights per site
+
+    Attributes
+    ----------
+    H: scipy sparse matrix
+        Interpolation matrix with shape (nobs,nstate)
+    inside: numpy array
+        Mask of sites inside the model domain
+    dims: tuple
+        Spatial dimensions defining the flattened state
+    lat_obs: numpy array
+        Latitude of observation sites
+    lon_obs: numpy array
+        Longitude of observation sites
+
+    Methods
+    -------
+    apply(x)
+        Interpolate fields with spatial dimensions dims
+        to the observation sites
+    apply_tiles(x)
+        Interpolate an ensemble read by tiles
+    subset(index)
+        Restrict the operator to a subset of sites
+    """
+
+    def __init__(self,rows,cols,weights,inside,shape,dims,lat_obs,lon_obs):
+        """
+        Parameters
+        ----------
+        rows: numpy array
+            Row (site) index of each weight
+        cols: numpy array
+            Column (flattened grid point) index of each weight
+        weights: numpy array
+            Bilinear interpolation weights
+        inside: numpy array
+            Mask of sites inside the model domain
+        shape: tuple
+            Shape (nobs,nstate) of the interpolation matrix
+        dims: tuple
+            Spatial dimensions defining the flattened state
+        lat_obs: numpy array
+            Latitude of observation sites
+        lon_obs: numpy array
+            Longitude of observation sites
+        """
+        self.H       = sparse.csr_matrix((weights,(rows,cols)),shape=tuple(shape))
+        self.inside  = inside
+        self.dims    = tuple(dims)
+        self.lat_obs = lat_obs
+        self.lon_obs = lon_obs
+        self.nobs, self.nstate = self.H.shape
+
+    def apply(self,x):
+        """
+        Interpolate fields to the observation sites
+
+        Parameters
+        ----------
+        x: numpy array or xarray
+            Fields with shape (...,nstate) or DataArray
+            with the spatial dimensions dims
+
+        Returns
+        -------
+        y: numpy array or xarray
+            Fields in the observation space with shape
+            (...,nobs) or DataArray with dimension loc
+        """
+        if isinstance(x,xr.DataArray):
+            x    = x.transpose(...,*self.dims)
+            dims = x.dims[:-len(self.dims)]
+            y = xr.DataArray(self.apply(x.values.reshape(x.shape[:len(dims)]+(-1,))),
+                             dims   = dims+('loc',),
+                             coords = {key: value for key,value in x.coords.items()
+                                                  if not set(value.dims) & set(self.dims)})
+            y.coords['lat'] = ('loc',self.lat_obs)
+            y.coords['lon'] = ('loc',self.lon_obs)
+            return y
+        shape = x.shape[:-1]
+        y = self.H @ np.reshape(x,(-1,self.nstate)).T
+        y = np.asarray(y).T.reshape(shape+(self.nobs,))
+        y[...,~self.inside] = np.nan
+        return y
+
+    def apply_tiles(self,x):
+        """
+        Interpolate an ensemble read by tiles of the
+        flattened state vector
+
+        Parameters
+        ----------
+        x: iterable
+            Pairs (tile,x_tile) of state ranges and arrays
+            with shape (n,ntile)
+
+        Returns
+        -------
+        y: numpy array
+            Fields in the observation space with shape (n,nobs)
+        """
+        H = self.H.tocsc()
+        y = None
+        for tile,xt in x:
+            yt = np.asarray(H[:,tile] @ xt.T).T
+            y  = yt if y is None else y + yt
+        y[...,~self.inside] = np.nan
+        return y
+
+    def subset(self,index):
+        """
+        Restrict the operator to a subset of sites
+
+        Parameters
+        ----------
+        index: array_like
+            Positions of the selected sites
+
+        Returns
+        -------
+        H: ObsOp
+            The observation operator for the selected sites
+        """
+        H = object.__new__(ObsOp)
+        H.H       = self.H[index]
+        H.inside  = self.inside[index]
+        H.dims    = self.dims
+        H.lat_obs = self.lat_obs[index]
+        H.lon_obs = self.lon_obs[index]
+        H.nobs, H.nstate = H.H.shape
+        return H
+
+def get_ObsOp(lat,lon,lat_obs,lon_obs,dims=('lat','lon'),path=None):
+    """
+    Get a bilinear observation operator for a (grid,site list)
+    pair. Operators are cached in memory and, optionally, on
+    disk using a hash of the grid and site coordinates
+
+    Parameters
+    ----------
+    lat: array_like
+        Latitude of grid points
+    lon: array_like
+        Longitude of grid points
+    lat_obs: array_like
+        Latitude of observation sites
+    lon_obs: array_like
+        Longitude of observation sites
+    dims: tuple, optional
+        Order of the spatial dimensions in the flattened state
+    path: str, optional
+        Folder for cached operators
+
+    Returns
+    -------
+    H: ObsOp
+        The observation operator
+    """
+    coords = {'lat': np.asarray(lat,dtype=float),
+              'lon': np.asarray(lon,dtype=float)}
+    lat_obs = np.asarray(lat_obs,dtype=float)
+    lon_obs = np.asarray(lon_obs,dtype=float)
+    #
+    key = hashlib.sha1("".join(dims).encode())
+    for item in [coords[dims[0]],coords[dims[1]],lat_obs,lon_obs]:
+        key.update(np.ascontiguousarray(item).tobytes())
+        key.update(b'|')
+    key = key.hexdigest()
+    if key in _cache: return _cache[key]
+    #
+    fname = None if path is None else join(path,"obsop_{}.npz".format(key))
+    if fname is not None and isfile(fname):
+        with np.load(fname) as data:
+            args = {item: data[item] for item in data.files}
+    else:
+        args = _get_weights(coords[dims[0]],coords[dims[1]],
+                            lat_obs if dims[0]=='lat' else lon_obs,
+                            lon_obs if dims[1]=='lon' else lat_obs)
+        if fname is not None:
+            makedirs(path,exist_ok=True)
+            np.savez(fname,**args)
+    _cache[key] = ObsOp(dims=dims,lat_obs=lat_obs,lon_obs=lon_obs,**args)
+    return _cache[key]
+
+def _get_weights(c1,c2,p1,p2):
+    """
+    Compute bilinear interpolation weights on a
+    rectilinear grid (c1,c2) at points (p1,p2)
+    """
+    i1,t1,in1 = _get_index(c1,p1)
+    i2,t2,in2 = _get_index(c2,p2)
+    n2   = len(c2)
+    nobs = len(p1)
+    rows = np.repeat(np.arange(nobs),4)
+    cols = np.stack([ i1   *n2 + i2,
+                      i1   *n2 + i2+1,
+                     (i1+1)*n2 + i2,
+                     (i1+1)*n2 + i2+1],axis=1).ravel()
+    weights = np.stack([(1-t1)*(1-t2),
+                        (1-t1)*t2,
+                        t1*(1-t2),
+                        t1*t2],axis=1).ravel()
+    return {'rows':    rows,
+            'cols':    cols,
+            'weights': weights,
+            'inside':  in1 & in2,
+            'shape':   np.array([nobs,len(c1)*n2])}
+
+def _get_index(c,p):
+    """
+    Find the lower grid index and the normalised distance of
+    points p in the (ascending or descending) coordinate c
+    """
+    if c[0] > c[-1]:
+        i,t,inside = _get_index(c[::-1],p)
+        return len(c)-2-i, 1-t, inside
+    inside = (p>=c[0]) & (p<=c[-1])
+    i = np.searchsorted(c,p,side='right')-1
+    i = np.clip(i,0,len(c)-2)
+    t = (p-c[i])/(c[i+1]-c[i])
+    t[~inside] = 0.0
+    return i, t, inside
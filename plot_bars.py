@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+import figdata
 import matplotlib.pyplot as plt
 from os.path import join
 
@@ -62,7 +63,7 @@ for bar in plot_bars:
     path  = bar['path']
     field = bar['field']
     label = bar['label']
-    df    = pd.read_csv(join(path,fname_csv))
+    df    = figdata.read_csv(join(path,fname_csv))
     df    = df[df.field==field]
     df['label'] = label
     frames.append(df)
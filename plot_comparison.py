@@ -1,8 +1,6 @@
-import pandas as pd
-import xarray as xr
+import figdata
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MultipleLocator
-from os.path import join
 from configparser import ConfigParser
 
 ###
@@ -15,6 +13,9 @@ config.read('config.ini')
 ### Parameters
 ###
 path_obs        = config.get('DATA','path')
+fname_obsstore  = config.get('DATA','fname_obsstore')
+path_cache      = config.get('DEFAULT','path_cache')
+fname_store     = config.get('DEFAULT','fname_store')
 fname_plt       = "figures/comparison.png"
 percentAss      = 60
 xmin,xmax       = 1E-4,1E2
@@ -54,10 +55,9 @@ fig, axs = plt.subplots(
 ####
 #### Read obs data
 ####
-fname_obs = "deposit_{:03d}.csv".format(percentAss)
-fname_obs = join(path_obs,fname_obs)
-if debug: print("Opening observation file: {}".format(fname_obs))
-df = pd.read_csv(fname_obs)
+fname_obs = figdata.get_obs_source(path_obs,percentAss,fname_obsstore)
+if debug: print("Opening observations: {} {:03d}".format(fname_obs,percentAss))
+df = figdata.read_observations(fname_obs,percentAss)
 nobs = len(df)
 if debug: print("Number of observations: {}".format(nobs))
 
@@ -66,21 +66,12 @@ for i,item in enumerate(rows):
     field = item['field']
     label = item['label']
     ###
-    ### Read model data
+    ### Read model data interpolated to observation sites
     ###
-    fname_an = "analysis_{:03d}.nc".format(percentAss)
-    fname_an = join(path,fname_an) 
-    if debug: print("Opening analysis file: {}".format(fname_an))
-    ds = xr.open_dataset(fname_an)
-    ###
-    ### Interpolation to observation sites
-    ###
-    if debug: print("Performing interpolations")
-    lat_obs = xr.DataArray(df['latitude'], dims='loc')
-    lon_obs = xr.DataArray(df['longitude'],dims='loc')
-    y       = ds.interp(lat=lat_obs,lon=lon_obs)
-    df['forecast'] = y.forecast
-    df['analysis'] = y.analysis
+    if debug: print("Opening analysis: {} {:03d}".format(path,percentAss))
+    values = figdata.get_values(path,percentAss,fname_obs,fname_store,path_cache)
+    df['forecast'] = values['forecast']
+    df['analysis'] = values['analysis']
     ###
     ### Plot 
     ###
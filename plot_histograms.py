@@ -1,9 +1,9 @@
 import numpy as np
-import pandas as pd
-import xarray as xr
+import figdata
 import matplotlib.pyplot as plt
 from scipy.special import gamma
 from os.path import join
+from obsop import get_ObsOp
 from configparser import ConfigParser
 
 ###
@@ -20,6 +20,7 @@ path_obs        = config.get('DATA','path')
 fname_obs       = config.get(block,'fname_obs')
 fname_ens       = config.get(block,'fname_ens')
 bulk_density    = config.getfloat(block,'bulk_density')
+path_cache      = config.get(block,'path_cache')
 fname_plt       = "figures/histograms.png"
 debug           = True
 
@@ -39,32 +40,27 @@ if debug:
 ### Read prior ensemble
 ###
 if debug: print(f"Opening prior ensemble file: {fname_ens}")
-ds = xr.open_dataset(fname_ens)
-#Convert mass loading (kg/m2) to thickness (cm)
-#using deposit bulk density (kg/m3)
-fu = 100.0/bulk_density
-x = fu*ds.isel(time=-1)['tephra_grn_load']
+x = figdata.open_ensemble(fname_ens,bulk_density)
 
 ###
 ### Read observation locations
 ###
 fname = join(path_obs,fname_obs)
 if debug: print(f"Opening observation file: {fname}")
-df = pd.read_csv(fname)
+df = figdata.read_csv(fname)
 indexes_loc = [164,165,108,86,
                198,199,19,203,
                47,68,58,46,
                66,85,84,195,
                ]               
-df = df.iloc[indexes_loc]
 
 ###
 ### Perform interpolations
 ###
 if debug: print("Performing interpolations")
-lat_obs = xr.DataArray(df['latitude'], dims='loc')
-lon_obs = xr.DataArray(df['longitude'],dims='loc')
-y = x.interp(lat=lat_obs,lon=lon_obs)
+H = get_ObsOp(x.lat,x.lon,df['latitude'],df['longitude'],path=path_cache)
+y = H.subset(indexes_loc).apply(x)
+df = df.iloc[indexes_loc]
 
 ###
 ### Plot histograms
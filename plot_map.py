@@ -1,10 +1,8 @@
-import xarray as xr
+import figdata
 import matplotlib.pyplot as plt
 from matplotlib.colors import BoundaryNorm
 import cartopy.crs as crs
-import cartopy.feature as cfeature
-import cartopy.io.shapereader as shpreader
-from os.path import join
+from basemap import draw_basemap
 from configparser import ConfigParser
 
 ###
@@ -19,9 +17,10 @@ config.read('config.ini')
 block           = 'DEFAULT'
 fname_out       = 'figures/maps.png'
 fname_obs       = config.get(block,'fname_obs')
-fname_sh        = config.get(block,'fname_sh')
+fname_basemap   = config.get(block,'fname_basemap')
 levels          = config.get(block,'levels')
-fname           = "analysis_100.nc"
+fname_store     = config.get(block,'fname_store')
+percentAss      = 100
 plot_obs        = False
 plot_shape      = True
 debug           = True
@@ -37,8 +36,6 @@ if debug:
     """)
 
 if plot_shape:
-    if debug: print("Opening shapefile file: {}".format(fname_sh))
-    reader = shpreader.Reader(fname_sh)
     labels = {'0.01cm':  {'lat': -35.60,
                           'lon': -73.1,
                           'name': "0.1"},
@@ -100,9 +97,8 @@ for i,item in enumerate(plots):
     path  = item['path']
     field = item['field']
     label = item['label']
-    fname_an = join(path,fname) 
-    if debug: print("Opening analysis file: {}".format(fname_an))
-    ds = xr.open_dataset(fname_an)
+    if debug: print("Opening analysis: {} {:03d}".format(path,percentAss))
+    ds = figdata.open_analysis(path,percentAss,fname_store)
 
     fc = axs.flat[i].contourf(ds.lon,ds.lat,10.0*ds[field],
                      levels = levels,
@@ -134,30 +130,13 @@ cbar=fig.colorbar(
         )
 cbar.set_label('Deposit thickness in mm', fontsize = 16)
 
-BORDERS = cfeature.NaturalEarthFeature(
-        scale='10m',
-        category='cultural',
-        name='admin_0_boundary_lines_land',
-        edgecolor='gray',
-        facecolor='none')
-
-LAND = cfeature.NaturalEarthFeature(
-        'physical', 'land', '10m',
-        edgecolor='none',
-        facecolor='lightgrey',
-        alpha = 0.8)
-
+if debug: print("Opening basemap cache: {}".format(fname_basemap))
+basemap = figdata.load_basemap(fname_basemap)
+layer_list = ['land','borders']
+if plot_shape: layer_list.append('isopachs')
 for ax in axs.flat:
-    ax.add_feature(BORDERS, linewidth=0.4)
-    ax.add_feature(LAND,zorder=0)
+    draw_basemap(ax,basemap,layer_list=layer_list)
     if plot_shape:
-        for item in reader.records():
-            ax.add_geometries(item.geometry,
-                              crs.PlateCarree(), 
-                              facecolor='None', 
-                              linewidths=1, 
-                              alpha=0.5)
-
         for key, value in labels.items():
             ax.text(value["lon"],
                     value["lat"],
@@ -1,10 +1,8 @@
-import pandas as pd
-import xarray as xr
+import figdata
 import matplotlib.pyplot as plt
 from matplotlib.colors import BoundaryNorm
 import cartopy.crs as crs
-import cartopy.feature as cfeature
-import cartopy.io.shapereader as shpreader
+from basemap import draw_basemap
 from configparser import ConfigParser
 
 ###
@@ -20,6 +18,7 @@ block           = 'DEFAULT'
 fname_out       = 'figures/maps_enkf.png'
 fname_obs       = 'DATA/deposit_060.csv'
 levels          = config.get(block,'levels')
+fname_basemap   = config.get(block,'fname_basemap')
 plot_obs        = True
 debug           = True
 
@@ -53,7 +52,7 @@ field = conf['field']
 label = conf['label']
 fname = conf['fname']
 if debug: print("Opening analysis file: {}".format(fname))
-ds = xr.open_dataset(fname)
+ds = figdata.open_dataset(fname)
 
 fc = ax.contourf(ds.lon,ds.lat,10.0*ds[field],
                  levels = levels,
@@ -74,21 +73,9 @@ cbar=fig.colorbar(
         label       = 'Deposit thickness in mm',
         )
 
-BORDERS = cfeature.NaturalEarthFeature(
-        scale='10m',
-        category='cultural',
-        name='admin_0_boundary_lines_land',
-        edgecolor='gray',
-        facecolor='none')
-
-LAND = cfeature.NaturalEarthFeature(
-        'physical', 'land', '10m',
-        edgecolor='none',
-        facecolor='lightgrey',
-        alpha = 0.8)
-
-ax.add_feature(BORDERS, linewidth=0.4)
-ax.add_feature(LAND,zorder=0)
+if debug: print("Opening basemap cache: {}".format(fname_basemap))
+basemap = figdata.load_basemap(fname_basemap)
+draw_basemap(ax,basemap)
 
 gl = ax.gridlines(crs=crs.PlateCarree(),
                   draw_labels = True,
@@ -117,7 +104,7 @@ if plot_obs:
 #                'label': 'Validation dataset (40%)',
 #                }
             ]
-    df = pd.read_csv(fname_obs)
+    df = figdata.read_csv(fname_obs)
     for item in scatter_conf:
         dataset = item['dataset']
         label   = item['label']
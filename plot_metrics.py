@@ -1,4 +1,4 @@
-import pandas as pd
+import figdata
 import matplotlib.pyplot as plt
 from os.path import join
 
@@ -63,7 +63,7 @@ fig, axs = plt.subplots(nax,
 for item in plot_items:
     path    = item['path']
     field   = item['field']
-    df   = pd.read_csv(join(path,fname_csv))
+    df   = figdata.read_csv(join(path,fname_csv))
     df   = df[(df.percentAss>15) & (df.percentAss<85)]
     y    = df[(df.dataset==dataset) & (df.field==field)]
     #
@@ -1,8 +1,8 @@
-import xarray as xr
 import numpy as np
 import matplotlib.pyplot as plt
 from datetime import datetime
 from os.path import join
+import figdata
 from configparser import ConfigParser
 
 ###
@@ -18,6 +18,7 @@ block           = "GNC"
 path            = config.get(block,'path')
 fname_src       = config.get(block,'fname_src')
 density         = config.getfloat(block,'bulk_density')
+percentAss      = 100
 fname_plt       = "figures/source.png"
 debug           = True
 
@@ -46,24 +47,23 @@ fig, ax = plt.subplots(figsize=(10,6))
 path      = plot_conf['path']
 time      = plot_conf['time']
 ###
-### Open ensemble of emission source terms
-###
-if debug: print(f"Opening emisison source file: {fname_src}")
-ds = xr.open_dataset(fname_src)
-###
 ### Open factor weights
 ###
-fname_w = join(path,f"factors_w.nc")
+fname_w = join(path,f"weights_{percentAss:03d}.nc")
 if debug: print(f"Opening weight factors file: {fname_w}")
-da = xr.open_dataarray(fname_w)
-ds['w'] = da 
+###
+### Weighted ensemble of emission source terms
+###
+if debug: print(f"Opening emisison source file: {fname_src}")
+src = figdata.reconstruct(fname_w,fname_src,'src')
+mfr = figdata.reconstruct(fname_w,fname_src,'mfr')
 #
-X = ds.time.values / 3600.0 # time in h
-Z = ds.lev.values  / 1000.0 # hight asl in km
+X = src.time.values / 3600.0 # time in h
+Z = src.lev.values  / 1000.0 # hight asl in km
 DT = (X[1]-X[0])*3600.      # time interval in sec
 #
-C = ds.src.dot(ds.w).values / 1000.0
-M = ds.mfr.dot(ds.w).values
+C = src.transpose('time','lev').values / 1000.0
+M = mfr.values
 #
 im = ax.pcolormesh(X,Z,C.T,
         shading = 'gouraud',
@@ -121,8 +121,6 @@ plt.legend( handles=[l2,l3] )
 #print("Total volume erupted:")
 #print(erupted)
 
-ds.close()
-
 if debug: print(f"Saving plot: {fname_plt}")
 fig.savefig(fname_plt,
             dpi=200,
@@ -0,0 +1,238 @@
+import json
+import tracemalloc
+import resource
+import pandas as pd
+from os import environ
+from os.path import isfile
+from time import perf_counter
+from functools import wraps
+from contextlib import contextmanager
+
+def _getenv(key):
+    """
+    Read a boolean flag from an environment variable
+    """
+    return environ.get(key,'').lower() in ['1','yes','true','on']
+
+class Profiler:
+    """
+    Collect named stage timers, counters and peak
+    memory samples of an assimilation run
+
+    Profiling is disabled by default. It can be enabled
+    using the enable method or the environment variables
+    ASSIM_PROFILE and ASSIM_TRACE_MEMORY
+
+    Attributes
+    ----------
+    enabled: bool
+        If stages and counters are recorded
+    trace_memory: bool
+        If the peak memory allocated in each stage is
+        measured using tracemalloc
+    times: dict
+        Accumulated wall-clock time in s of each stage
+    memory: dict
+        Peak memory in MB of each stage (only if
+        trace_memory is enabled)
+    counters: dict
+        Counters and sizes
+
+    Methods
+    -------
+    enable(trace_memory=False)
+        Start recording
+    stage(name)
+        Context manager timing a stage
+    set(name,value)
+        Set a counter
+    add(name,value=1)
+        Increment a counter
+    get_record(**meta)
+        Return a flat record of the current run
+    dump(fname,**meta)
+        Append the record of the current run to a
+        JSON lines or CSV file and reset
+    reset()
+        Clear timers and counters
+    """
+
+    def __init__(self):
+        self.enabled      = False
+        self.trace_memory = False
+        self._stack       = []
+        self.reset()
+        if _getenv('ASSIM_PROFILE') or _getenv('ASSIM_TRACE_MEMORY'):
+            self.enable(_getenv('ASSIM_TRACE_MEMORY'))
+
+    def enable(self,trace_memory=False):
+        """
+        Start recording
+
+        Parameters
+        ----------
+        trace_memory: bool, optional
+            If allocations should be traced using tracemalloc.
+            Otherwise, only the maximum resident set size of
+            the process is added to the records
+        """
+        self.enabled      = True
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def reset(self):
+        """
+        Clear timers and counters
+        """
+        self.times    = {}
+        self.memory   = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self,name):
+        """
+        Context manager timing a stage. Nested stages
+        are named using the parent/child convention
+
+        Parameters
+        ----------
+        name: str
+            Name of the stage
+        """
+        if not self.enabled:
+            yield
+            return
+        if self._stack:
+            name = self._stack[-1]['name'] + '/' + name
+        entry = {'name': name}
+        if self.trace_memory:
+            current,peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'],peak)
+            tracemalloc.reset_peak()
+            entry['start'] = entry['peak'] = current
+        self._stack.append(entry)
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name,0.0) + perf_counter()-t0
+            self._stack.pop()
+            if self.trace_memory:
+                peak = max(tracemalloc.get_traced_memory()[1],entry['peak'])
+                if self._stack:
+                    self._stack[-1]['peak'] = max(self._stack[-1]['peak'],peak)
+                peak = (peak-entry['start'])/1024**2
+                self.memory[name] = max(self.memory.get(name,0.0),peak)
+
+    def set(self,name,value):
+        """
+        Set a counter
+
+        Parameters
+        ----------
+        name: str
+            Name of the counter
+        value: int or float
+            Value of the counter
+        """
+        if self.enabled: self.counters[name] = value
+
+    def add(self,name,value=1):
+        """
+        Increment a counter
+
+        Parameters
+        ----------
+        name: str
+            Name of the counter
+        value: int or float, optional
+            Increment
+        """
+        if self.enabled: self.counters[name] = self.counters.get(name,0) + value
+
+    def get_record(self,**meta):
+        """
+        Return a flat record of the current run
+
+        Parameters
+        ----------
+        meta: dict
+            Additional fields identifying the run,
+            e.g. method, percentAss or sample
+
+        Returns
+        -------
+        record: dict
+            Fields time.<stage> (s), memory.<stage> (MB, only
+            if trace_memory is enabled), memory.max_rss (MB,
+            maximum resident set size of the process) and the
+            counters
+        """
+        record = dict(meta)
+        record.update({'time.'+key: value for key,value in self.times.items()})
+        record.update({'memory.'+key: value for key,value in self.memory.items()})
+        #Maximum resident set size in kB (Linux)
+        record['memory.max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+        record.update(self.counters)
+        return record
+
+    def dump(self,fname,**meta):
+        """
+        Append the record of the current run to a file
+        and reset timers and counters. Nothing is done
+        if profiling is disabled
+
+        Parameters
+        ----------
+        fname: str
+            Output file. A CSV table is used for the .csv
+            extension and JSON lines otherwise
+        meta: dict
+            Additional fields identifying the run
+        """
+        if not self.enabled: return
+        write_records([self.get_record(**meta)],fname)
+        self.reset()
+
+def write_records(records,fname):
+    """
+    Append profiling records to a JSON lines
+    or CSV file
+
+    Parameters
+    ----------
+    records: list
+        List of dict records
+    fname: str
+        Output file
+    """
+    if fname.endswith('.csv'):
+        df = pd.DataFrame(records)
+        if isfile(fname):
+            df = pd.concat([pd.read_csv(fname),df],ignore_index=True)
+        df.to_csv(fname,index=False)
+    else:
+        with open(fname,'a') as f:
+            for record in records:
+                f.write(json.dumps(record,default=_to_json)+'\n')
+
+def _to_json(value):
+    """
+    Convert numpy scalars to python types
+    """
+    return value.item() if hasattr(value,'item') else str(value)
+
+def profile(name):
+    """
+    Decorator timing a method of an object with
+    a profiler attribute as the stage name
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self,*args,**kwargs):
+            with self.profiler.stage(name):
+                return func(self,*args,**kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,437 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import netCDF4
+from glob import glob
+from os import replace
+from os.path import join, isfile, dirname, basename, getmtime
+from ensemble import EnsembleStats
+
+_stores = {}
+_observations = {}
+
+fname_analysis = "analysis_{:03d}.nc"
+fname_weights  = "weights_{:03d}.nc"
+fname_deposit  = "deposit_{:03d}.csv"
+obs_columns    = ['latitude','longitude','thickness','error','error_r','cluster']
+
+def write_analysis(fname,method,percentAss,forecast,analysis,sample=None):
+    """
+    Append an analysis to a consolidated NetCDF4 store. The
+    forecast is saved once in the root group and analyses
+    are saved in a group for each method as a chunked and
+    compressed variable with dimensions (percentAss,sample,...).
+    The percentAss and sample coordinates are kept sorted,
+    so the store can be sliced by label
+
+    Parameters
+    ----------
+    fname: str
+        Store file
+    method: str
+        The assimilation method (group name)
+    percentAss: int
+        Percentage of assimilated observations
+    forecast: xarray
+        Forecast field
+    analysis: xarray
+        Analysis field. Realisations are saved at once if
+        a sample dimension is defined
+    sample: int, optional
+        Realisation number if analysis has no sample dimension
+
+    Raises
+    ------
+    ValueError
+        If the store was written with another grid or forecast
+    """
+    dims = forecast.dims
+    mode = 'a' if isfile(fname) else 'w'
+    with netCDF4.Dataset(fname,mode) as nc:
+        if 'forecast' in nc.variables:
+            _check_forecast(nc,forecast,fname)
+        else:
+            for dim in dims:
+                nc.createDimension(dim,forecast.sizes[dim])
+                var = nc.createVariable(dim,forecast[dim].dtype,(dim,))
+                var[:] = forecast[dim].values
+            var = nc.createVariable('forecast',forecast.dtype,dims,zlib=True)
+            var[:] = forecast.values
+        #
+        if method in nc.groups:
+            group = nc.groups[method]
+        else:
+            group = nc.createGroup(method)
+            group.createDimension('percentAss',None)
+            group.createDimension('sample',None)
+            group.createVariable('percentAss','i4',('percentAss',))
+            group.createVariable('sample','i4',('sample',))
+            group.createVariable('analysis',analysis.dtype,('percentAss','sample')+dims,
+                                 zlib       = True,
+                                 chunksizes = (1,1)+forecast.shape,
+                                 fill_value = np.nan)
+        #
+        analysis = analysis.transpose(...,*dims)
+        if 'sample' in analysis.dims:
+            samples = analysis['sample'].values
+            values  = analysis.values
+        else:
+            samples = [1 if sample is None else sample]
+            values  = analysis.values[None]
+        ip = _get_index(group['percentAss'],percentAss,group['analysis'],0)
+        for sample,value in zip(samples,values):
+            group['analysis'][ip,_get_index(group['sample'],sample,group['analysis'],1)] = value
+
+def open_analysis(path,percentAss,fname_store=None):
+    """
+    Open the forecast and analysis of a run
+
+    Parameters
+    ----------
+    path: str
+        Output folder (METHOD or METHOD/NNN for realisations)
+    percentAss: int
+        Percentage of assimilated observations
+    fname_store: str, optional
+        Consolidated store. The most recent source is read
+        (see get_source): the store entry of the run, the file
+        path/analysis_XXX.nc or the analysis reconstructed from
+        path/weights_XXX.nc
+
+    Returns
+    -------
+    ds: xarray Dataset
+        Dataset with forecast and analysis fields
+    """
+    fname = get_source(path,percentAss,fname_store)
+    if fname == fname_store:
+        da = _get_entry(fname_store,path,percentAss)
+        return xr.Dataset({'forecast': open_store(fname_store)['forecast'],
+                           'analysis': da.drop_vars(['percentAss','sample'])})
+    if fname.endswith(fname_weights.format(percentAss)):
+        return open_weights(fname)
+    return xr.open_dataset(fname)
+
+def get_source(path,percentAss,fname_store=None):
+    """
+    File read by open_analysis: the most recently modified of
+    the consolidated store (only if it has an entry for the
+    run), the analysis file and the weights file. Weights
+    saved by a later run (e.g. with weights_only) are not
+    hidden by older analyses
+    """
+    fname   = join(path,fname_analysis.format(percentAss))
+    fname_w = join(path,fname_weights.format(percentAss))
+    files   = [item for item in [fname,fname_w] if isfile(item)]
+    if fname_store and _get_entry(fname_store,path,percentAss) is not None:
+        files.insert(0,fname_store)
+    if not files: return fname
+    return max(files,key=getmtime)
+
+def write_weights(fname,w,fname_ens,bulk_density,**attrs):
+    """
+    Save the weight factors of the ensemble members and
+    a reference to the ensemble file
+
+    Parameters
+    ----------
+    fname: str
+        Weights file
+    w: xarray
+        Weight factors with dimension ens
+    fname_ens: str
+        The ensemble FALL3D output file
+    bulk_density: float
+        The deposit bulk density in kg/m3
+    attrs: optional
+        Additional attributes (e.g. solver information)
+    """
+    w = w.copy()
+    w.name  = 'w'
+    w.attrs = {'fname_ens':    fname_ens,
+               'bulk_density': bulk_density,
+               **{key: int(value) if isinstance(value,(bool,np.bool_)) else value
+                  for key,value in attrs.items()}}
+    w.to_netcdf(fname)
+
+def read_weights(fname):
+    """
+    Read the weight factors of the ensemble members
+
+    Returns
+    -------
+    w: xarray
+        Weight factors with attributes fname_ens
+        and bulk_density
+    """
+    with xr.open_dataarray(fname) as w:
+        return w.load()
+
+def reconstruct(w,fname,variable,isel=None,sel=None,scale=1.0,nchunk=1):
+    """
+    Compute weighted sums over the ensemble members of a
+    variable (e.g. an analysis or the src and mfr source
+    terms) reading nchunk members at once
+
+    Parameters
+    ----------
+    w: xarray
+        Weight factors with dimension ens and an optional
+        second dimension for several weighted sums
+    fname: str
+        Ensemble file
+    variable: str
+        Variable name
+    isel: dict, optional
+        Integer indexers applied before reading the data
+        (e.g. {'time': -1})
+    sel: dict, optional
+        Label indexers applied before reading the data
+        (e.g. a sub-region {'lat': slice(-42,-40)})
+    scale: float, optional
+        Scale factor of the weighted sums
+    nchunk: int, optional
+        Number of members read at once
+
+    Returns
+    -------
+    da: xarray
+        Weighted sums with the dimensions of w (except
+        ens) and the dimensions of the variable
+    """
+    w = w.transpose('ens',...)
+    with xr.open_dataset(fname,cache=False) as ds:
+        da = ds[variable]
+        if isel: da = da.isel(isel)
+        if sel:  da = da.sel(sel)
+        if 'ens' in w.coords and 'ens' in da.coords:
+            da = da.sel(ens=w['ens'].values)
+        da       = da.transpose('ens',...)
+        template = da.isel(ens=0,drop=True)
+        stats    = EnsembleStats(template.size,weights=w.values.reshape(w.sizes['ens'],-1))
+        for i in range(0,da.sizes['ens'],nchunk):
+            stats.update(da.isel(ens=slice(i,i+nchunk)).values.reshape(-1,template.size))
+        coords = {key: value for key,value in w.coords.items() if not 'ens' in value.dims}
+        coords.update({key: value.load() for key,value in template.coords.items()})
+    return xr.DataArray(scale*stats.sums.reshape(w.shape[1:]+template.shape),
+                        dims   = w.dims[1:]+template.dims,
+                        coords = coords)
+
+def open_weights(fname):
+    """
+    Reconstruct the forecast and analysis of a run from
+    the weights file in a single pass over the ensemble
+
+    Returns
+    -------
+    ds: xarray Dataset
+        Dataset with forecast and analysis fields
+    """
+    w     = read_weights(fname)
+    attrs = w.attrs
+    w     = xr.concat([xr.full_like(w,1.0/w.sizes['ens']),w],dim='field')
+    w['field'] = ['forecast','analysis']
+    #Convert mass loading (kg/m2) to thickness (cm)
+    da = reconstruct(w,attrs['fname_ens'],'tephra_grn_load',
+                     isel  = {'time': -1},
+                     scale = 100.0/attrs['bulk_density'])
+    return da.to_dataset(dim='field')
+
+def open_store(fname):
+    """
+    Open a consolidated store lazily as a DataTree. The
+    tree is opened once and reused in later calls
+    """
+    if not fname in _stores:
+        _stores[fname] = xr.open_datatree(fname)
+    return _stores[fname]
+
+def write_observations(fname,path_obs):
+    """
+    Build a columnar observation store from the files
+    path_obs/deposit_XXX.csv. Site columns are saved once
+    with a boolean split mask for each percentage of
+    assimilated observations. Sites included in more
+    splits come first, so nested splits are leading
+    slices of the columns
+
+    Parameters
+    ----------
+    fname: str
+        Observation store (npz)
+    path_obs: str
+        Folder with the observation files
+    """
+    files = sorted(glob(join(path_obs,"deposit_[0-9][0-9][0-9].csv")))
+    if not files:
+        raise FileNotFoundError("Observation files not found in: {}".format(path_obs))
+    frames = [pd.read_csv(fname_obs) for fname_obs in files]
+    df     = frames[0]
+    for fname_obs,item in zip(files,frames):
+        if not item[obs_columns].equals(df[obs_columns]):
+            raise ValueError("Observation sites differ in file: {}".format(fname_obs))
+    masks = np.stack([item['dataset'].to_numpy()=='assimilation' for item in frames])
+    index = np.lexsort((np.arange(len(df)),-masks.sum(axis=0)))
+    data  = {column: df[column].to_numpy()[index] for column in obs_columns}
+    data['index']      = index
+    data['percentAss'] = np.array([int(basename(item)[8:11]) for item in files])
+    data['splits']     = masks[:,index]
+    #Atomic update: several processes can open the store
+    fname_tmp = fname + ".tmp"
+    with open(fname_tmp,'wb') as f:
+        np.savez(f,**data)
+    replace(fname_tmp,fname)
+
+def open_observations(fname):
+    """
+    Open a columnar observation store. The store is built
+    again if it is older than the observation files in the
+    same folder. It is read once and reused in later calls
+
+    Returns
+    -------
+    obs: ObservationSet
+        Observation sites and splits
+    """
+    path_obs = dirname(fname)
+    files    = glob(join(path_obs,"deposit_[0-9][0-9][0-9].csv"))
+    if files and (not isfile(fname) or getmtime(fname) < max(getmtime(item) for item in files)):
+        _observations.pop(fname,None)
+        write_observations(fname,path_obs)
+    if not fname in _observations:
+        _observations[fname] = ObservationSet(fname)
+    return _observations[fname]
+
+def get_obs_source(path_obs,percentAss,fname_obsstore=None):
+    """
+    File read by the observation readers: the observation
+    store or the file path_obs/deposit_XXX.csv
+    """
+    if fname_obsstore: return join(path_obs,fname_obsstore)
+    return join(path_obs,fname_deposit.format(percentAss))
+
+def read_observations(fname,percentAss):
+    """
+    Read the observation table of a split with the
+    columns of the deposit_XXX.csv files (including the
+    assimilation/validation dataset labels)
+
+    Parameters
+    ----------
+    fname: str
+        Observation store (npz) or observation file (csv)
+    percentAss: int
+        Percentage of assimilated observations
+    """
+    if not fname.endswith('.npz'): return pd.read_csv(fname)
+    return open_observations(fname).get_table(percentAss)
+
+class ObservationSet:
+    """
+    Observation sites read from a columnar store (see
+    write_observations). Splits are returned as views of
+    the site columns
+
+    Attributes
+    ----------
+    columns: dict
+        Site columns sorted by split
+    index: numpy array
+        Row of each site in the observation files
+    sites: pandas DataFrame
+        Site coordinates in the order of the observation files
+    """
+
+    def __init__(self,fname):
+        with np.load(fname) as f:
+            self.columns = {column: f[column] for column in obs_columns}
+            self.index   = f['index']
+            masks        = f['splits']
+            self.splits  = dict(zip(f['percentAss'].tolist(),masks))
+        order = np.argsort(self.index)
+        self.sites = pd.DataFrame({column: self.columns[column][order]
+                                   for column in ['latitude','longitude']},
+                                  index = self.index[order])
+
+    def get_split(self,percentAss):
+        """
+        Assimilated sites of a split
+
+        Returns
+        -------
+        index: numpy array
+            Row of each site in the observation files
+        columns: dict
+            Site columns. Views of the store columns if the
+            split is a leading slice
+        """
+        if not percentAss in self.splits:
+            raise KeyError("Split not found: {}".format(percentAss))
+        mask = self.splits[percentAss]
+        nobs = int(mask.sum())
+        if mask[:nobs].all():
+            rows = slice(0,nobs)
+        else:
+            rows = np.flatnonzero(mask)
+        return self.index[rows], {key: value[rows] for key,value in self.columns.items()}
+
+    def get_table(self,percentAss):
+        """
+        Observation table of a split in the order of the
+        observation files, with the dataset labels
+        """
+        index,_ = self.get_split(percentAss)
+        df = pd.DataFrame(self.columns,index=self.index)
+        df['dataset'] = 'validation'
+        df.loc[index,'dataset'] = 'assimilation'
+        return df.sort_index()
+
+def _check_forecast(nc,forecast,fname):
+    """
+    Check that the grid and the forecast of a store
+    match the forecast of a new analysis
+    """
+    var = nc['forecast']
+    if var.dimensions != forecast.dims or var.shape != forecast.shape:
+        raise ValueError("Grid of the store {} does not match the analysis".format(fname))
+    for dim in forecast.dims:
+        if not np.array_equal(nc[dim][:],forecast[dim].values):
+            raise ValueError("Coordinate {} of the store {} does not match the analysis".format(dim,fname))
+    #Single precision ensembles give slightly different forecasts
+    if not np.allclose(var[:],forecast.values,rtol=1e-5,atol=0,equal_nan=True):
+        raise ValueError("Forecast of the store {} does not match the analysis. "
+                         "Use a new store for another ensemble".format(fname))
+
+def _get_entry(fname,path,percentAss):
+    """
+    Analysis of a run in a consolidated store or None if
+    the store has no entry for the run
+    """
+    if not isfile(fname): return None
+    method, _, sample = path.strip('/').partition('/')
+    tree = open_store(fname)
+    if not method in tree.children: return None
+    da = tree[method]['analysis']
+    sample = int(sample) if sample else da['sample'].values[0]
+    if not (percentAss in da['percentAss'].values and sample in da['sample'].values):
+        return None
+    return da.sel(percentAss=percentAss,sample=sample)
+
+def _get_index(var,value,data,axis):
+    """
+    Position of value in a sorted coordinate variable with
+    an unlimited dimension. A missing value is inserted at
+    its sorted position: the following slices of data along
+    axis are shifted by one and the new slice is cleared
+    """
+    values = np.asarray(var[:])
+    index  = int(np.searchsorted(values,value))
+    if index < len(values) and values[index] == value: return index
+    key = (slice(None),)*axis
+    #Shift one slice at a time to bound memory usage
+    for i in range(len(values)-1,index-1,-1):
+        var[i+1] = values[i]
+        data[key+(i+1,)] = data[key+(i,)]
+    var[index] = value
+    if index < len(values): data[key+(index,)] = np.nan
+    return index
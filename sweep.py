@@ -0,0 +1,241 @@
+import numpy as np
+import pandas as pd
+import assimilation
+from profiler import write_records
+from store import get_obs_source, open_observations, write_analysis, fname_weights
+from time import perf_counter
+from os import getpid
+from os.path import join
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from configparser import ConfigParser
+
+###
+### Read configuration file
+###
+config = ConfigParser(inline_comment_prefixes="#")
+config.read('config.ini')
+
+###
+### Parameters
+###
+block           = 'SWEEP'
+path_obs        = config.get('DATA','path')
+fname_obsstore  = config.get('DATA','fname_obsstore')
+fname_ens       = config.get(block,'fname_ens')
+bulk_density    = config.getfloat(block,'bulk_density')
+lazy_loading    = config.getboolean(block,'lazy_loading')
+max_memory      = config.getfloat(block,'max_memory')
+precision       = config.get(block,'precision')
+path_cache      = config.get(block,'path_cache')
+fname_store     = config.get(block,'fname_store')
+profiling       = config.getboolean(block,'profiling')
+trace_memory    = config.getboolean(block,'trace_memory')
+fname_profile   = config.get(block,'fname_profile')
+methods         = config.get(block,'methods').split()
+max_workers     = config.getint(block,'max_workers')
+fname_timings   = config.get(block,'fname_timings')
+weights_only    = config.getboolean('GNC','weights_only')
+random_sort     = {'GNC': False, 'GIG': True, 'ENKF': False}
+debug           = True
+
+###
+### Ensemble and assimilation methods loaded once per worker
+###
+_methods = {}
+
+def get_method(method):
+    """
+    Build an assimilation method using the
+    parameters of the configuration file
+
+    Parameters
+    ----------
+    method: str
+        The assimilation method: GNC, GIG or ENKF
+
+    Returns
+    -------
+    data: AssimilationMethod
+        The assimilation method instance
+    """
+    if method == 'GNC':
+        data = assimilation.GNC(config.getint(method,'max_iterations'),
+                                solver        = config.get(method,'solver'),
+                                tolerance     = config.getfloat(method,'tolerance'),
+                                kkt_tolerance = config.getfloat(method,'kkt_tolerance'))
+    elif method == 'GIG':
+        data = assimilation.GIG(config.getfloat(method,'thickness_min'),
+                                tile_size   = config.getint(method,'tile_size'),
+                                max_workers = config.getint(method,'max_workers'))
+    else:
+        data = assimilation.ENKF(config.get(method,'solver'),
+                                 radius      = config.getfloat(method,'localization'),
+                                 taper       = config.get(method,'taper'),
+                                 tile_size   = config.getint(method,'tile_size'),
+                                 max_workers = config.getint(method,'max_workers'))
+    return data
+
+def init_worker():
+    """
+    Read the ensemble once and build one instance
+    for each assimilation method
+    """
+    for method in methods:
+        data = get_method(method)
+        if profiling: data.profiler.enable(trace_memory)
+        if _methods:
+            data.share_ensemble(next(iter(_methods.values())))
+        else:
+            data.read_ensemble(fname_ens,bulk_density,
+                               lazy       = lazy_loading,
+                               max_memory = max_memory,
+                               dtype      = precision)
+        _methods[method] = data
+
+def run_task(method,percentAss,sample,seed):
+    """
+    Assimilate a single observation subset
+
+    Parameters
+    ----------
+    method: str
+        The assimilation method
+    percentAss: int
+        Percentage of assimilated observations
+    sample: int
+        Realisation number (GIG) or None
+    seed: numpy SeedSequence
+        Seed for the global random state of the worker
+
+    Returns
+    -------
+    timings: dict
+        Wall-clock time of each stage in seconds, the
+        profiling record if profiling is enabled and the
+        forecast and analysis fields if a consolidated
+        store is used (written by the parent process).
+        GNC weights are always saved and the analysis is
+        skipped if weights_only is set
+    """
+    timings = {'method': method,
+               'percentAss': percentAss,
+               'sample': sample,
+               'pid': getpid()}
+    np.random.seed(seed.generate_state(1))
+    data = _methods[method]
+    path = config.get(method,'path')
+    if sample is not None: path = join(path,"{:03d}".format(sample))
+    #
+    fname_obs = get_obs_source(path_obs,percentAss,fname_obsstore)
+    fname_an  = "analysis_{:03d}.nc".format(percentAss)
+    fname_an  = join(path,fname_an)
+    fname_w   = join(path,fname_weights.format(percentAss))
+    update    = not (method == 'GNC' and weights_only)
+    #
+    def assimilate():
+        if method == 'GNC':
+            data.assimilate(update=update)
+        else:
+            data.assimilate()
+    def save():
+        if method == 'GNC': data.weights_to_netcdf(fname_w)
+        if not update: return
+        if fname_store:
+            #NetCDF4 appends from several processes are unsafe
+            timings['fields'] = (data.xfm,data.xam)
+        else:
+            data.to_netcdf(fname_an)
+    stages = [('read_observations', lambda: data.read_observations(fname_obs,random_sort[method],percentAss)),
+              ('apply_ObsOp',       lambda: data.apply_ObsOp(path_cache)),
+              ('assimilate',        assimilate),
+              ('to_netcdf',         save),
+              ]
+    t0 = perf_counter()
+    for stage,func in stages:
+        t = perf_counter()
+        func()
+        timings[stage] = perf_counter()-t
+    timings['total'] = perf_counter()-t0
+    timings['nobs']  = data.nobs
+    if data.profiler.enabled:
+        timings['profile'] = data.profiler.get_record(method     = method,
+                                                      percentAss = percentAss,
+                                                      sample     = sample)
+        data.profiler.reset()
+    return timings
+
+if __name__ == '__main__':
+    ###
+    ### Information screen
+    ###
+    if debug:
+        print("""
+        ---------------------------------------
+        Assimilation sweep using a process pool
+        ---------------------------------------
+        Input parameters:
+        methods = {methods}
+        number of workers = {max_workers}
+        consolidated store: {fname_store}
+        """.format(methods     = " ".join(methods),
+                   max_workers = max_workers,
+                   fname_store = fname_store or "no")
+              )
+
+    ###
+    ### Define (method,percentAss,sample) work items
+    ###
+    tasks = []
+    for method in methods:
+        if method == 'GIG':
+            samples = range(1,1+config.getint(method,'nsample'))
+        else:
+            samples = [None]
+        for percentAss in np.arange(10,105,5):
+            for sample in samples:
+                tasks.append((method,int(percentAss),sample))
+    seeds = np.random.SeedSequence().spawn(len(tasks))
+
+    ###
+    ### Build the observation store once before
+    ### starting the workers
+    ###
+    if fname_obsstore:
+        if debug: print("Opening observation store: {}".format(join(path_obs,fname_obsstore)))
+        open_observations(join(path_obs,fname_obsstore))
+
+    ###
+    ### Run tasks
+    ###
+    t0 = perf_counter()
+    data = []
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             initializer=init_worker) as executor:
+        futures = [executor.submit(run_task,*task,seed) for task,seed in zip(tasks,seeds)]
+        for future in as_completed(futures):
+            timings = future.result()
+            if 'fields' in timings:
+                t = perf_counter()
+                write_analysis(fname_store,timings['method'],timings['percentAss'],
+                               *timings.pop('fields'),sample=timings['sample'])
+                timings['to_netcdf'] += perf_counter()-t
+                timings['total']     += perf_counter()-t
+            if debug: print("Finished {method} percentAss={percentAss} sample={sample}: {total:.2f} s".format(**timings))
+            data.append(timings)
+    elapsed = perf_counter()-t0
+    profiles = [timings.pop('profile') for timings in data if 'profile' in timings]
+
+    ###
+    ### Wall-clock breakdown
+    ###
+    df = pd.DataFrame(data)
+    df.sort_values(['method','percentAss','sample'],inplace=True)
+    if debug:
+        print(df.groupby('method')[['read_observations','apply_ObsOp','assimilate','to_netcdf','total']].sum())
+        print("Elapsed time: {:.2f} s".format(elapsed))
+        print("Accumulated task time: {:.2f} s".format(df.total.sum()))
+        print("Saving timings file: {}".format(fname_timings))
+    df.to_csv(fname_timings,index=False)
+    if profiles:
+        if debug: print("Saving profiling records: {}".format(fname_profile))
+        write_records(profiles,fname_profile)